@@ -1,7 +1,7 @@
 """ Arxiv fetching class. """
 
 
-from fetch import Fetch
+from fetch import Fetch, PageParser
 import re
 # import feedparser
 
@@ -9,6 +9,84 @@ types = {'title': 'ti', 'author': 'au', 'abs': 'ab', 'msc': 'soc',
          'journal': 'jr', 'doi': 'doi', 'cat': 'cat', 'none': '', 'co': 'co'}
 
 
+class ResultsParser(PageParser):
+
+    """
+    Collect arXiv number, title and authors of each listed preprint.
+
+    Records are dictionaries with keys id, title and authors.
+    """
+
+    def __init__(self, limit=None):
+        """ Nothing found yet. """
+        PageParser.__init__(self, limit)
+        self.notFound = False
+        self.done = False
+        self.record = None
+        # list collecting text of the title or of an author
+        self.text = None
+        self.pageTitle = None
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if self.done:
+            return
+        if tag == 'title':
+            self.pageTitle = []
+        elif tag == 'table' and attrs.get('class') == 'listing':
+            self._finish()
+            self.record = {'id': None, 'title': None, 'authors': []}
+        elif tag == 'p' and attrs.get('class') == 'fromto':
+            # listing is over
+            self._finish()
+            self.done = True
+        elif self.record is None:
+            return
+        elif tag == 'a':
+            href = attrs.get('href') or ''
+            if self.record['id'] is None and href.startswith('/'):
+                self.record['id'] = href[1:]
+            elif 'author' in href and self.record['title'] is not None:
+                self.text = []
+                self.record['authors'].append(self.text)
+        elif tag == 'b' and self.record['title'] is None:
+            self.text = self.record['title'] = []
+        elif self.text is not None and self.record['authors']:
+            # only the name after the last tag inside author link is used
+            del self.text[:]
+
+    def handle_endtag(self, tag):
+        if tag == 'title' and self.pageTitle is not None:
+            self.notFound = ''.join(self.pageTitle) == 'Front: Not found'
+            self.pageTitle = None
+        elif tag in ('a', 'b'):
+            self.text = None
+        elif self.text is not None and self.record['authors']:
+            del self.text[:]
+
+    def handle_data(self, data):
+        if self.pageTitle is not None:
+            self.pageTitle.append(data)
+        elif self.text is not None:
+            self.text.append(data)
+
+    def close(self):
+        PageParser.close(self)
+        if not self.done:
+            self._finish()
+
+    def _finish(self):
+        """ Store current record. """
+        r = self.record
+        self.record = self.text = None
+        if r and r['id'] and r['title'] is not None:
+            r['title'] = re.sub(r'\s*\.\s*$', '', ''.join(r['title']))
+            # remove (...) sometimes appearing in authors
+            r['authors'] = [re.sub(r'\(\w+\)', '', ''.join(a))
+                            for a in r['authors']]
+            self.records.append(r)
+
+
 class ArXiv(Fetch):
 
     """
@@ -18,12 +96,15 @@ class ArXiv(Fetch):
 
     """
 
-    url = "http://front.math.ucdavis.edu/search?n=200&"
+    url = "http://front.math.ucdavis.edu/search?"
     website = "http://front.math.ucdavis.edu/search?n=200&"
     more = ""
+    size = "n="
+    onceMax = 200
+    parser = ResultsParser
 
-    def _preprocessQuery(self, query):
-        """ Catch arxiv number query or execute regular preprocessing. """
+    def _idQuery(self, query):
+        """ Catch arxiv number query if present. """
         match = re.search(
             r"(?si)(arxiv:|\\arxiv\s*\{|arxiv\s*=\s*\{)\s*\d{4}\.\d{4,5}",
             query)
@@ -33,8 +114,7 @@ class ArXiv(Fetch):
             # so make sure unique
             ids = list(set(re.findall(r"\d{4}\.\d{4,5}(?:v\d)?", query)))
             return [("id", '[' + ' '.join(ids[:10]) + ']')]
-        else:
-            return super(ArXiv, self)._preprocessQuery(query)
+        return None
 
     def _formatQuery(self, lst):
         """
@@ -101,32 +181,22 @@ class ArXiv(Fetch):
 
     def _processResults(self, data):
         """ Get bibtex data from arxiv html. """
-        if re.match("(?si).*<title>Front: Not found</title>.*", data):
+        page = self._parse(data)
+        if page.notFound:
             self.refs = ""
             return
-        data = re.sub(r'(?si).*?<table class="listing">', "", data, 1)
-        data = re.sub(r'(?si)<p class="fromto">.*', "", data)
-        data = data.split(r'<table class="listing">')
-        self.refs = []
-        for d in data:
-            m = re.match(
-                r'(?si).*href="/([^"]+).*?<b>(.*?)\s*\.\s*</b>(\n|\s)*(.*)', d)
-            arxiv, title, authors = m.group(1, 2, 4)
-            authors = re.sub(r'(?si)((.*)author.*?)</a>.*', r'\1', authors)
-            # remove (...) sometimes appearing in authors
-            authors = re.sub(r'\(\w+\)', '', authors)
-            authors = re.split('</a>\s*,?\s*', authors)
-            authors = [', '.join(re.split('\s*<.*>', a)[::-1]) for a in authors]
+        refs = []
+        for r in page.records:
+            # author names are used as last names
+            authors = [a + ', ' for a in r['authors']]
             d = """
             @unpublished{{{2},
                     author = {{{0}}},
                     title = {{{{{1}}}}},
                     arxiv = {{{2}}},
-            }}""".format(' and '.join(authors), title, arxiv)
-            self.refs.append(d)
-        self.refs = '\n'.join(self.refs)
-        self.refs = self.refs.replace(r'&lt;', '<').replace(r'&gt;', '>') \
-            .replace(r'&amp;', '&')
+            }}""".format(' and '.join(authors), r['title'], r['id'])
+            refs.append(d)
+        self.refs = '\n'.join(refs)
 
     def _cleanWebsite(self, data):
         """ Extract highlights from the website. """
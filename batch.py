@@ -3,10 +3,16 @@
 from msn import MathSciNet, MRef
 from zbl import Zbl
 from arxiv import ArXiv
-from fetch import fixQuery
+from fetch import prepareQuery
+import bibfile
 import re
+import threading
+import time
 from collections import defaultdict
 
+# lookups in flight during batch runs, network limits requests per host
+THREADS = 32
+
 
 class Batch(object):
 
@@ -24,62 +30,142 @@ class Batch(object):
 
     As an option, run arXiv before others and return its result if unique.
     As another option, do not try to find zbl, or mr, when unique match found.
+
+    With batchParallel option all searches start at once. Results are still
+    used in the above order, and searches that are no longer needed are
+    cancelled.
+
+    The timeout option limits the time of the whole cascade. Without
+    batchParallel the remaining time is split between the remaining stages.
+    When time runs out, records found so far are returned and self.partial
+    is set. If nothing was found and some source could not be reached,
+    self.failed is set, and sources skipped because of their circuit breaker
+    are listed in self.skipped.
+
+    The fetcher whose records are returned is kept in self.result, so that
+    references of a whole batch can be formatted together, see formatRefs.
     """
 
     def __call__(self, query, count, dct):
         """ Imitate __call__ function from Fetch. """
-        query = fixQuery(query)
         d = defaultdict(str)
         d.update(dct)
         dct = d
         # TODO start with arxiv?
-        bibs = ""
-        mref = MRef()
-        mref.fetch(query, count)
-        self.number = 1
-        self.nonunique = False
-        if mref.number:
-            # MRef found a match
-            return mref.refs, mref.getRefs(**dct)
-        # now check Zbl
+        self.count = count
+        # fetcher whose records are returned
+        self.result = None
+        self.partial = False
+        self.failed = False
+        self.deadline = None
+        if dct["timeout"]:
+            self.deadline = time.time() + float(dct["timeout"])
         if dct["batchFindMR"]:
             # run MRef too
             zbl = Zbl(otherID=True)
         else:
             zbl = Zbl()
-        zbl.fetch(query, count)
-        if zbl.number:
+        self.stages = [MRef(), zbl, MathSciNet(), ArXiv()]
+        # parse only once for all stages
+        self.query = query = prepareQuery(query, self.stages)
+        self.threads = {}
+        if dct["batchParallel"]:
+            # start all searches now, but use them in the usual order
+            for f in self.stages:
+                f.deadline = self.deadline
+                t = threading.Thread(target=f.fetch, args=(query, count))
+                t.daemon = True
+                t.start()
+                self.threads[f] = t
+        try:
+            return self._cascade(dct)
+        finally:
+            # stop searches whose results are no longer needed
+            for f in self.stages:
+                f.cancel.set()
+            self.skipped = [f.__class__.__name__ for f in self.stages
+                            if f.skipped]
+
+    def _timeLeft(self):
+        """ Seconds until deadline, or None if there is no deadline. """
+        if self.deadline is None:
+            return None
+        return max(0, self.deadline - time.time())
+
+    def _wait(self, fetcher):
+        """
+        Wait for fetcher to finish, or run it now if it was not started.
+
+        Returns False if fetcher did not finish in time. Its results must
+        not be used then.
+        """
+        left = self._timeLeft()
+        if fetcher in self.threads:
+            self.threads[fetcher].join(left)
+            done = not self.threads[fetcher].is_alive()
+        elif left is None:
+            fetcher.fetch(self.query, self.count)
+            done = True
+        else:
+            # split remaining time between this and the following stages
+            stages = len(self.stages) - self.stages.index(fetcher)
+            fetcher.deadline = time.time() + left / stages
+            done = left > 0
+            if done:
+                fetcher.fetch(self.query, self.count)
+        if not done or fetcher.partial:
+            self.partial = True
+        return done
+
+    def _use(self, fetcher, dct):
+        """ Return BibTex and LaTeX outputs of fetcher. """
+        self.result = fetcher
+        return fetcher.refs, fetcher.getRefs(**dct)
+
+    def _cascade(self, dct):
+        """ Use results of the stages in order of priority. """
+        mref, zbl, msn, ar = self.stages
+        bibs = []
+        self.number = 1
+        self.nonunique = False
+        if self._wait(mref) and mref.number:
+            # MRef found a match
+            return self._use(mref, dct)
+        # now check Zbl
+        if self._wait(zbl) and zbl.number:
             # Zbl found something
-            bibs = zbl.refs
+            bibs = list(zbl.records)
             if not zbl.nonunique:
                 # return only if unique match found
-                return zbl.refs, zbl.getRefs(**dct)
+                return self._use(zbl, dct)
         # now check MSN
-        msn = MathSciNet()
-        msn.fetch(query, count)
-        if msn.number:
+        if self._wait(msn) and msn.number:
             # MSN found something
             if not msn.nonunique:
                 # return only if unique match found
-                return msn.refs, msn.getRefs(**dct)
+                return self._use(msn, dct)
             # combine msn and zbl records
-            bibs += '\n\n' + msn.refs
-        ar = ArXiv()
-        ar.fetch(query, count)
-        if ar.number:
+            bibs += msn.records
+        if self._wait(ar) and ar.number:
             # arXiv found something
             if not ar.nonunique and not bibs:
                 # return only if unique match found and nothing found so far
-                return ar.refs, ar.getRefs(**dct)
-            bibs += '\n\n' + ar.refs
+                return self._use(ar, dct)
+            bibs += ar.records
         if bibs:
-            # format and return combined records
+            # format and return combined records without duplicates
             # this is a nonunique result
-            msn.setBibtex(bibs)
+            # stages may still be running, so use a fresh fetcher
+            msn = MathSciNet()
+            # keep the bibitem found in the query, like the stages do
+            msn.bibitem = self.query.bibitem
+            msn.setRecords(bibfile.unique(bibs))
             self.number = msn.number
             self.nonunique = True
-            return msn.refs, msn.getRefs(**dct)
+            return self._use(msn, dct)
         # nothing was found, return the query
+        # but a failed source might have had a match
+        self.failed = any(f.failed for f in self.stages)
         self.number = 0
         self.nanunique = True
         return '', ''
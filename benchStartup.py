@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+"""
+Measure startup time of the terminal interface.
+
+Usage: benchStartup.py [-n runs] [query]
+
+Reports median times of:
+    bare interpreter start
+    cold import of citeTerminal (sources compiled on every run)
+    warm import of citeTerminal (compiled files present)
+    whole cite.py run for query, after a first run filled the cache
+and the modules taking most time to import in a warm run. Python 2 has
+no -X importtime, so import times are collected by an __import__ hook.
+Everything runs on a temporary copy of the sources, so no compiled files
+are left next to them.
+"""
+
+import compileall
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+_PATH = os.path.dirname(os.path.realpath(__file__))
+_IMPORT = "import sys; sys.path.insert(0, {0!r}); import citeTerminal"
+# import hook printing self and cumulative time of each new module
+_HOOK = """
+import sys, time, __builtin__
+sys.path.insert(0, {0!r})
+_import = __builtin__.__import__
+stack = []
+times = []
+def hook(name, *args, **kwargs):
+    new = name not in sys.modules
+    start = time.time()
+    stack.append(0.0)
+    try:
+        return _import(name, *args, **kwargs)
+    finally:
+        inner = stack.pop()
+        total = time.time() - start
+        if stack:
+            stack[-1] += total
+        if new and name in sys.modules:
+            times.append((total - inner, total, name))
+__builtin__.__import__ = hook
+import citeTerminal
+for t in times:
+    print '%f %f %s' % t
+"""
+
+
+def median(values):
+    """ Middle value of a list. """
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def timeRun(args, runs, env=None):
+    """ Median wall time in seconds of running args. """
+    times = []
+    with open(os.devnull, 'w') as null:
+        for _ in range(runs):
+            start = time.time()
+            subprocess.call(args, stdout=null, stderr=null, env=env)
+            times.append(time.time() - start)
+    return median(times)
+
+
+def copySources():
+    """ Return temporary folder with the files needed by cite.py. """
+    copy = tempfile.mkdtemp()
+    for name in os.listdir(_PATH):
+        if name.endswith(('.py', '.bst')) or name == 'settings.xml':
+            shutil.copy(os.path.join(_PATH, name), copy)
+    return copy
+
+
+def importBreakdown(path, runs, top=15):
+    """ Median (self, cumulative) import times of the slowest modules. """
+    samples = {}
+    for _ in range(runs):
+        out = subprocess.check_output(
+            [sys.executable, '-c', _HOOK.format(path)])
+        for line in out.splitlines():
+            own, total, name = line.split()
+            samples.setdefault(name, []).append((float(own), float(total)))
+    rows = [(median([s[0] for s in v]), median([s[1] for s in v]), k)
+            for k, v in samples.items()]
+    return sorted(rows, reverse=True)[:top]
+
+
+def main():
+    args = sys.argv[1:]
+    runs = 10
+    if args[:1] == ['-n']:
+        runs = int(args[1])
+        args = args[2:]
+    ms = lambda t: '{0:8.1f} ms'.format(1000 * t)
+    copy = copySources()
+    try:
+        print 'bare interpreter', ms(timeRun([sys.executable, '-c', 'pass'],
+                                             runs))
+        # -B keeps the copy free of compiled files
+        print 'cold import     ', ms(timeRun(
+            [sys.executable, '-B', '-c', _IMPORT.format(copy)], runs))
+        # make sure compiled files exist, even with PYTHONDONTWRITEBYTECODE
+        compileall.compile_dir(copy, maxlevels=0, quiet=1)
+        print 'warm import     ', ms(timeRun(
+            [sys.executable, '-c', _IMPORT.format(copy)], runs))
+        if args:
+            cite = [sys.executable, os.path.join(copy, 'cite.py')] + args
+            # first run fills the cache
+            timeRun(cite, 1)
+            print 'cached query    ', ms(timeRun(cite, runs))
+        print
+        print '    self cumulative  module'
+        for own, total, name in importBreakdown(copy, runs):
+            print ms(own), ms(total), '', name
+    finally:
+        shutil.rmtree(copy, ignore_errors=True)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
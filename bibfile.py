@@ -0,0 +1,281 @@
+"""
+Fast BibTeX reader and writer for records returned by search engines.
+
+The output is the same as from bibtexparser (version 0.6) with the same
+settings, but records are split with a single regular expression, values
+are cleaned up without per character loops, and nothing is logged.
+Sources containing @string, @comment or @preamble are rare, and are
+passed to bibtexparser itself.
+"""
+
+import re
+
+# entry types kept by bibtexparser, others are ignored
+_STANDARD = frozenset(['article', 'book', 'booklet', 'conference', 'inbook',
+                       'incollection', 'inproceedings', 'manual',
+                       'mastersthesis', 'misc', 'phdthesis', 'proceedings',
+                       'techreport', 'unpublished'])
+# alternative names of fields
+_ALIASES = {'keyw': 'keyword', 'keywords': 'keyword', 'authors': 'author',
+            'editors': 'editor', 'url': 'link', 'urls': 'link',
+            'links': 'link', 'subjects': 'subject'}
+_SPECIAL = re.compile(r'(?i)@\s*(string|comment|preamble)')
+# a record starts on a line beginning with @
+_RECORD = re.compile(r'(?m)^[^\S\n]*@')
+_RECORD_UNICODE = re.compile(_RECORD.pattern, re.UNICODE)
+_FIELDS = re.compile(r',\s*\n|\n\s*,')
+# field with value in braces, e.g. TITLE = {Title}
+_SIMPLE = re.compile(r'(\w+)\s*=\s*\{([^{}#]*)\}$')
+_CONCAT = re.compile(r'((?P<pre>"?)\s*(#|^)\s*(?P<id>[^\d\W]\w*)\s*(#|$)'
+                     r'\s*(?P<post>"?))', re.UNICODE)
+_BRACE = re.compile(r'[{}]')
+# field names seen so far, they repeat in every record
+_names = {}
+
+
+def loads(text, customization=None):
+    """
+    Parse BibTeX string and return the list of records.
+
+    Each record is a dictionary of lower case fields, with entry type
+    stored under ENTRYTYPE and the key under ID. customization is called
+    on each record, and should return it.
+    """
+    if _SPECIAL.search(text):
+        # string definitions and comments need the full parser
+        import bibtexparser
+        from bibtexparser.bparser import BibTexParser
+        parser = BibTexParser()
+        parser.customization = customization
+        return bibtexparser.loads(text, parser=parser).entries
+    starts = _RECORD_UNICODE if isinstance(text, unicode) else _RECORD
+    starts = [m.end() - 1 for m in starts.finditer(text)]
+    ends = [text.rfind('\n', 0, i) + 1 for i in starts[1:]] + [len(text)]
+    records = []
+    for start, end in zip(starts, ends):
+        record = _parseRecord(text[start:end])
+        if record:
+            if customization is not None:
+                record = customization(record)
+            records.append(record)
+    return records
+
+
+def _parseRecord(record):
+    """ Parse a single record the way bibtexparser does. """
+    record = '\n'.join([line.strip() for line in record.split('\n')])
+    if '}\n' in record:
+        record = record.replace('\r\n', '\n').replace('\r', '\n') \
+            .rstrip('\n')
+        # missing comma after the last field
+        if record.endswith('}\n}'):
+            record = record[:-3] + '},\n}'
+        elif record.endswith('}}'):
+            record = record[:-2] + '},\n}'
+    d = {}
+    inkey = ""
+    inval = ""
+    for kv in [i.strip() for i in _FIELDS.split(record)]:
+        simple = None if inkey else _SIMPLE.match(kv)
+        if simple:
+            # shortcut for the usual case handled by _value
+            val = simple.group(2).strip()
+            if val.startswith('"') and val.endswith('"'):
+                val = val[1:-1].strip()
+            if val and not isinstance(val, unicode):
+                val = unicode(val, 'utf8', 'ignore')
+            d[_fieldName(simple.group(1))] = val
+        elif kv.startswith('@') and not inkey:
+            bibtype, key = kv.split('{', 1)
+            bibtype = _fieldName(bibtype)
+            key = key.lstrip().strip('}').strip(',')
+            if bibtype not in _STANDARD:
+                break
+        elif '=' in kv and not inkey:
+            field, val = [i.strip() for i in kv.split('=', 1)]
+            field = _fieldName(field)
+            if '#' in val:
+                val = _concatenate(val)
+            if val.count('{') != val.count('}') or \
+                    (val.startswith('"') and
+                     not val.replace('}', '').endswith('"')):
+                # value continues on the next line
+                inkey = field
+                inval = val
+            else:
+                d[field] = _value(val)
+        elif inkey:
+            inval += ', ' + kv
+            if (inval.startswith('{') and inval.endswith('}')) or \
+                    (inval.startswith('"') and inval.endswith('"')):
+                d[inkey] = _value(inval)
+                inkey = ""
+                inval = ""
+    if not d:
+        return d
+    d['ENTRYTYPE'] = bibtype
+    d['ID'] = key
+    return d
+
+
+def _fieldName(name):
+    """ Lower case field name or entry type, with aliases resolved. """
+    try:
+        return _names[name]
+    except KeyError:
+        pass
+    field = name.strip().strip('@').lower()
+    field = _ALIASES.get(field, field)
+    if not isinstance(field, unicode):
+        field = unicode(field, 'utf-8')
+    if len(_names) < 1000:
+        _names[name] = field
+    return field
+
+
+def _concatenate(val):
+    """ Join parts of a value separated by #. """
+    def repl(m):
+        pre = '"' if m.group('pre') != '"' else ''
+        post = '"' if m.group('post') != '"' else ''
+        return pre + m.group('id') + post
+    return _CONCAT.sub(repl, val)
+
+
+def _stripBraces(val):
+    """ Remove braces enclosing the whole value. """
+    val = val.strip()
+    if val.startswith('{') and val.endswith('}'):
+        if val.find('}') == len(val) - 1:
+            # no inner braces, the usual case
+            return val[1:-1]
+        depth = 0
+        for m in _BRACE.finditer(val):
+            depth += 1 if m.group(0) == '{' else -1
+            if depth == 0:
+                if m.start() != len(val) - 1:
+                    # first brace closes before the end
+                    return val
+                break
+        return val[1:-1]
+    return val
+
+
+def _value(val):
+    """ Strip delimiters and decode value. """
+    if not val or val == "{}":
+        return ''
+    val = _stripBraces(val)
+    val = val.strip()
+    if val.startswith('"') and val.endswith('"'):
+        val = val[1:-1]
+    val = _stripBraces(val)
+    if not val:
+        return ''
+    if not isinstance(val, unicode):
+        val = unicode(val, 'utf8', 'ignore')
+    return val
+
+
+def dumps(records, indent=' ', order=('ID',)):
+    """
+    Write records in BibTeX format.
+
+    Fields are sorted alphabetically, and records by the order fields.
+    """
+    if order:
+        records = sorted(records, key=lambda r: tuple(
+            unicode(r.get(field, '')).lower() for field in order))
+    out = []
+    for r in records:
+        out.append('@' + r['ENTRYTYPE'] + '{' + r['ID'])
+        for field in sorted(r):
+            if field not in ('ENTRYTYPE', 'ID'):
+                out.append(",\n" + indent + field + " = {" + r[field] + "}")
+        out.append("\n}\n\n")
+    return ''.join(out)
+
+
+def _intern(name):
+    """ Share a single copy of each field name between records. """
+    try:
+        return intern(str(name))
+    except UnicodeError:
+        return name
+
+
+class Record(object):
+
+    """
+    Compact BibTeX record.
+
+    Fields are kept as a sorted tuple of (name, value) pairs with interned
+    names. Identifiers used for merging are stored as attributes, and are
+    None if the record does not have them.
+    """
+
+    __slots__ = ('type', 'key', 'fields', 'mr', 'zbl', 'arxiv', 'doi')
+
+    def __init__(self, entrytype, key, fields):
+        """ Create record from an iterable of (name, value) pairs. """
+        self.type = entrytype
+        self.key = key
+        self.fields = tuple(sorted((_intern(n), v) for n, v in fields))
+        value = dict(self.fields).get
+        self.mr = value('mrnumber')
+        self.zbl = value('zbl')
+        self.arxiv = value('arxiv')
+        self.doi = value('doi')
+
+    @classmethod
+    def fromEntry(cls, entry):
+        """ Create record from a dictionary returned by loads. """
+        return cls(entry['ENTRYTYPE'], entry['ID'],
+                   [(k, v) for k, v in entry.iteritems()
+                    if k not in ('ENTRYTYPE', 'ID')])
+
+    def identifiers(self):
+        """ Set of (kind, value) pairs identifying the publication. """
+        return set((kind, getattr(self, kind).strip().lower())
+                   for kind in ('mr', 'zbl', 'arxiv', 'doi')
+                   if getattr(self, kind))
+
+    def bibtex(self, indent=' '):
+        """ Write record the way dumps does. """
+        out = ['@' + self.type + '{' + self.key]
+        for name, value in self.fields:
+            out.append(",\n" + indent + name + " = {" + value + "}")
+        out.append("\n}\n\n")
+        return ''.join(out)
+
+    def toJSON(self):
+        """ Return JSON serializable form of the record. """
+        return [self.type, self.key, self.fields]
+
+    @classmethod
+    def fromJSON(cls, data):
+        """ Recreate record saved by toJSON. """
+        return cls(data[0], data[1], data[2])
+
+
+def records(text, customization=None):
+    """ Parse BibTeX string into a list of Records. """
+    return [Record.fromEntry(e) for e in loads(text, customization)]
+
+
+def write(records, indent=' '):
+    """ Write Records in BibTeX format, keeping their order. """
+    return ''.join([r.bibtex(indent) for r in records])
+
+
+def unique(records):
+    """ Drop records sharing an identifier with an earlier record. """
+    seen = set()
+    kept = []
+    for r in records:
+        ids = r.identifiers()
+        if ids & seen:
+            continue
+        seen |= ids
+        kept.append(r)
+    return kept
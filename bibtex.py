@@ -1,9 +1,15 @@
 """ Class for handling BibTex interactions. """
 
 from collections import defaultdict
-from tempfile import NamedTemporaryFile as tempFile
+from contextlib import contextmanager
+import atexit
 import os
 import re
+import shutil
+import subprocess
+import tempfile
+import threading
+import cache
 
 
 # HTML formatting for LaTex commands
@@ -13,6 +19,134 @@ _HTML = {
     'textbf': r'<font style="font-weight:bold;">',
     'textsc': r'<font style="font-variant:small-caps;">',
 }
+_TIMEOUT = 30   # seconds bibtex may run
+_IDLE = 4       # work directories kept for reuse
+# memory backed file system for work directories, if there is one
+_TMPFS = '/dev/shm'
+# bibtex reads citations, style and database names from the .aux file
+_AUX = '\\citation{*}\n\\bibstyle{cite}\n\\bibdata{cite}\n'
+
+# options used by BibTex.adjustBst, besides all *Style ones
+_STYLE_OPTIONS = ('sortBy', 'genBibitems', 'bibitemStyle', 'html', 'query')
+# options used by BibTex.removeNumbers, after the type prefix
+_NUMBER_OPTIONS = ('MRZbl', 'Arxiv', 'IncludeDOIURL', 'DOIURL')
+_TEMPLATE = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                         'default.bst')
+
+_idle = []
+_idleLock = threading.Lock()
+# adjusted styles and sort order, keyed by styleKey
+_styles = cache.LRUCache(32)
+# whether bibtex is installed, checked by hasBibtex
+_installed = None
+
+
+@contextmanager
+def workDirectory():
+    """
+    Empty directory for a single bibtex run.
+
+    Directories are reused by later runs, so concurrent runs never share
+    one, and nothing is created or removed on most calls.
+    """
+    with _idleLock:
+        path = _idle.pop() if _idle else None
+    if path is None:
+        base = _TMPFS if os.access(_TMPFS, os.W_OK) else None
+        path = tempfile.mkdtemp(prefix='cite', dir=base)
+    try:
+        yield path
+    finally:
+        for name in os.listdir(path):
+            os.unlink(os.path.join(path, name))
+        with _idleLock:
+            if len(_idle) < _IDLE:
+                _idle.append(path)
+                path = None
+        if path is not None:
+            shutil.rmtree(path, ignore_errors=True)
+
+
+@atexit.register
+def _removeIdle():
+    """ Remove work directories kept for reuse. """
+    with _idleLock:
+        for path in _idle:
+            shutil.rmtree(path, ignore_errors=True)
+        del _idle[:]
+
+
+def runBibtex(bst, bibstr, timeout=_TIMEOUT):
+    """
+    Run bibtex with style bst on all entries of bibstr.
+
+    Returns the contents of the .bbl file, or "" if bibtex failed or did not
+    finish in timeout seconds.
+    """
+    with workDirectory() as path:
+        for ext, text in (('bst', bst), ('bib', bibstr), ('aux', _AUX)):
+            if isinstance(text, unicode):
+                text = text.encode('utf-8')
+            with open(os.path.join(path, 'cite.' + ext), 'w') as f:
+                print >>f, text
+        with open(os.devnull, 'w') as null:
+            try:
+                process = subprocess.Popen(['bibtex', 'cite'], cwd=path,
+                                           stdout=null, stderr=null)
+            except OSError:
+                # bibtex is not installed
+                return ""
+            timer = threading.Timer(timeout, process.kill)
+            timer.start()
+            try:
+                process.wait()
+            finally:
+                timer.cancel()
+        if process.returncode < 0:
+            # killed, the output is not complete
+            return ""
+        try:
+            with open(os.path.join(path, 'cite.bbl'), 'r') as f:
+                return f.read()
+        except IOError:
+            return ""
+
+
+def hasBibtex():
+    """ True if bibtex is installed. """
+    global _installed
+    if _installed is None:
+        from distutils.spawn import find_executable
+        _installed = find_executable('bibtex') is not None
+    return _installed
+
+
+def styleKey(format_dct):
+    """
+    Key of the style adjusted for format_dct.
+
+    Consists of the options changing the style and of the modification
+    time of the template, so that edits of default.bst are picked up.
+    """
+    options = sorted((k, v) for k, v in format_dct.items()
+                     if k in _STYLE_OPTIONS or re.match('(.*)Style', k))
+    try:
+        mtime = os.path.getmtime(_TEMPLATE)
+    except OSError:
+        mtime = None
+    return mtime, tuple(options)
+
+
+def outputKey(format_dct):
+    """ Key of all options changing the output of BibTex.run. """
+    p = format_dct.get('type', '')
+    numbers = tuple(format_dct.get(p + k, '') for k in _NUMBER_OPTIONS)
+    return styleKey(format_dct), p, numbers, _builtin(format_dct)
+
+
+def _builtin(format_dct):
+    """ True if the built-in interpreter formats references, see runMany. """
+    return bool(format_dct.get('builtinBst')) or not hasBibtex()
 
 
 class BibTex(object):
@@ -27,22 +161,16 @@ class BibTex(object):
         """
         ddct = defaultdict(str)
         ddct.update(format_dct)
-        bst = tempFile(delete=False, suffix='.bst')
-        self.name = os.path.splitext(bst.name)[0]
-        self.shortname = os.path.split(self.name)[1]
-        self.path = os.path.split(bst.name)[0]
         self.fdict = ddct
-        with open(self.name + '.tex', 'w') as f:
-            print >>f, r"""
-                \documentclass{{article}}
-                \begin{{document}}
-                \nocite{{*}}
-                \bibliographystyle{{{0}}}
-                \bibliography{{{0}}}
-                \end{{document}}""".format(self.shortname)
-
-        path = os.path.dirname(os.path.realpath(__file__))
-        with open(path + '/default.bst', 'r') as f:
+
+        # the same options are used for every result and batch entry
+        key = styleKey(format_dct)
+        style = _styles.get(key)
+        if style is not None:
+            self.bst, self.reverse = style
+            return
+
+        with open(_TEMPLATE, 'r') as f:
             template = f.read()
 
         if ddct["query"]:
@@ -50,8 +178,8 @@ class BibTex(object):
             self.reverse = False
         else:
             template = self.adjustBst(ddct, format_dct, template)
-        print >>bst, template
-        bst.close()
+        self.bst = template
+        _styles.put(key, (self.bst, self.reverse))
 
     def adjustBst(self, ddct, format_dct, template):
         """ Adjust bst file to the format given by format_dct. """
@@ -107,20 +235,35 @@ class BibTex(object):
 
     def run(self, bibstr):
         """Execute BibTex with entries from bibstr, and retrieve the results."""
-        with open(self.name + '.bib', 'w') as f:
-            print >>f, bibstr
-        try:
-            os.system('cd {}; pdflatex -interaction=batchmode {} >/dev/null'
-                      .format(self.path, self.shortname))
-            os.system('cd {}; bibtex {} >/dev/null'
-                      .format(self.path, self.shortname))
-            with open(self.name + '.bbl', 'r') as f:
-                data = f.read()
-            self.cleanup('blg', 'aux', 'bib', 'log', 'bbl')
-        except:
-            self.cleanup('blg', 'aux', 'bib', 'log', 'bbl')
-            return ""
-        # postprocess data
+        return self.runMany([bibstr])[0]
+
+    def runMany(self, bibstrs):
+        """
+        Format each of bibstrs separately, e.g. all entries of a batch.
+
+        Every string gets its own labels and order, as if run was called on
+        it. References are formatted by bibtex, or by the built-in
+        interpreter (bst.run) if bibtex is not installed, fails, or the
+        builtinBst option is set. The interpreter parses and compiles the
+        style only once for all strings.
+        """
+        import bst
+        builtin = _builtin(self.fdict)
+        results = []
+        for bibstr in bibstrs:
+            data = "" if builtin else runBibtex(self.bst, bibstr)
+            if not data:
+                try:
+                    data = bst.run(self.bst, bibstr)
+                except Exception:
+                    # style the interpreter can not handle, let bibtex try
+                    if builtin:
+                        data = runBibtex(self.bst, bibstr)
+            results.append(self.postprocess(data) if data else "")
+        return results
+
+    def postprocess(self, data):
+        """ Turn .bbl contents into the final output. """
         data = re.sub(r"^[\n\r\s]*", "", data)
         data = re.sub(r"(?<=[^\n])\n", " ", data)
         data = re.sub(r" +", " ", data)
@@ -203,18 +346,3 @@ class BibTex(object):
                 # remove DOI
                 data = re.sub(r'(?si)DOI_START.*?DOI_END', '', data)
         return data
-
-    def cleanup(self, *args):
-        """ Remove temporary files. """
-        for l in args:
-            try:
-                os.unlink(self.name + '.' + l)
-            except:
-                pass
-
-    def __del__(self):
-        """ Remove remaining temporary files. """
-        try:
-            self.cleanup('tex', 'bst')
-        except:
-            pass
@@ -0,0 +1,1591 @@
+"""
+BibTeX style interpreter.
+
+Runs a .bst style on a .bib database and returns the text bibtex would
+write to the .bbl file for \\nocite{*}, without TeX or bibtex installed.
+The built-in functions follow bibtex 0.99 (bibtex.web) closely, including
+name parsing and formatting, brace and special character handling in
+purify$, change.case$ and text.prefix$, and breaking of long output lines.
+Errors in the style or the data are handled the way bibtex handles them:
+an offending function pushes an empty string or zero and the run goes on.
+
+Strings are byte strings, unicode input is encoded as UTF-8.
+"""
+
+import re
+import string
+import threading
+from functools import partial
+
+ENT_STR_SIZE = 250    # longest entry string variable, entry.max$
+GLOB_STR_SIZE = 20000  # longest global string variable, global.max$
+_MAX_PRINT_LINE = 79  # longer output lines are broken at white space
+_MIN_PRINT_LINE = 3
+# ties follow shorter beginnings of name parts, e.g. D.~E. Knuth
+_LONG_TOKEN = 3
+_LONG_NAME = 3  # for the tie at the end of a part
+_IDLE_MACHINES = 8  # machines kept for reuse by each style
+_NAMES = 5000  # split name lists kept by a machine between runs
+
+_WHITE = ' \t'
+_SEP = '-~'
+_ALPHA = frozenset(string.ascii_letters + ''.join(map(chr, range(128, 256))))
+_ALNUM = _ALPHA | frozenset(string.digits)
+_UPPER = frozenset(string.ascii_uppercase)
+_LOWER = frozenset(string.ascii_lowercase)
+# bibtex changes case of ASCII letters only
+_TO_LOWER = string.maketrans(string.ascii_uppercase, string.ascii_lowercase)
+_TO_UPPER = string.maketrans(string.ascii_lowercase, string.ascii_uppercase)
+# purify$ of strings without braces: separators become spaces,
+# other characters which are not letters or digits are removed
+_PURIFY = string.maketrans('\t-~', '   ')
+_PURIFY_DELETE = ''.join(chr(i) for i in range(128)
+                         if chr(i) not in _ALNUM and chr(i) not in ' \t-~')
+# control sequences of foreign letters, e.g. {\ss}
+_SPECIAL = frozenset(['i', 'j', 'oe', 'OE', 'ae', 'AE', 'aa', 'AA', 'o', 'O',
+                      'l', 'L', 'ss'])
+_SPECIAL_UPPER = frozenset(['OE', 'AE', 'AA', 'O', 'L'])
+# character widths in hundredths of a point of cmr10, for width$
+_WIDTHS = dict(zip(
+    ' !"#$%&\'()*+,-./0123456789:;<=>?@',
+    [278, 278, 500, 833, 500, 833, 778, 278, 389, 389, 500, 778, 278, 333,
+     278, 500] + [500] * 10 + [278, 278, 278, 778, 472, 472, 778]))
+_WIDTHS.update(zip(
+    string.ascii_uppercase,
+    [750, 708, 722, 764, 681, 653, 785, 750, 361, 514, 778, 625, 917, 750,
+     778, 681, 778, 736, 556, 722, 750, 750, 1028, 750, 750, 611]))
+_WIDTHS.update(zip(
+    string.ascii_lowercase,
+    [500, 556, 444, 556, 444, 306, 500, 556, 278, 306, 528, 278, 833, 556,
+     500, 556, 528, 392, 394, 389, 556, 528, 722, 528, 528, 444]))
+_WIDTHS.update({'[': 278, '\\': 500, ']': 278, '^': 500, '_': 278,
+                '`': 278, '{': 500, '|': 1000, '}': 500, '~': 500})
+_SPECIAL_WIDTHS = {'ss': 500, 'ae': 722, 'oe': 778, 'AE': 903, 'OE': 1014}
+
+_BST_TOKEN = re.compile(r'''
+    \s+ | %[^\n]*
+    | (?P<brace>[{}])
+    | "(?P<str>[^"\n]*)"
+    | \#(?P<int>[-+]?\d+)
+    | '(?P<quote>[^\s{}%"]+)
+    | (?P<name>[^\s{}%"\#']+)
+    | (?P<bad>.)''', re.VERBOSE)
+_BIB_SPACE = re.compile(r'[ \t\r\n]*')
+_BIB_WHITE = re.compile(r'[ \t\r\n]+')
+_BIB_ID = re.compile(r'[^\s"#%\'(),={}]+')
+_BIB_NUMBER = re.compile(r'\d+')
+_BIB_KEY = {'{': re.compile(r'[^\s,}]*'), '(': re.compile(r'[^\s,]*')}
+
+
+class StyleError(Exception):
+
+    """ Style file that cannot be run. """
+
+
+def run(style, bib):
+    """ Run style (text of a .bst file) on bib and return the .bbl text. """
+    return Style.get(style).run(bib)
+
+
+class _Function(object):
+
+    """ Named item of a style: function, variable or field. """
+
+    __slots__ = ('name', 'kind', 'value')
+
+    def __init__(self, name, kind, value=None):
+        self.name = name
+        self.kind = kind
+        self.value = value
+
+    def __repr__(self):
+        return '<bst %s %s>' % (self.kind, self.name)
+
+
+# kinds of _Function, value is given in brackets
+_BUILTIN = 'built-in'      # [Machine method]
+_USER = 'function'         # [list of body items]
+_FIELD = 'field'           # [_Missing pushed when the field is missing]
+_ENTRY_INT = 'entry integer'
+_ENTRY_STR = 'entry string'
+_GLOBAL_INT = 'global integer'
+_GLOBAL_STR = 'global string'
+_VARIABLES = (_ENTRY_INT, _ENTRY_STR, _GLOBAL_INT, _GLOBAL_STR)
+# type of values of variables
+_TYPES = {_ENTRY_INT: int, _GLOBAL_INT: int, _ENTRY_STR: str, _GLOBAL_STR: str}
+
+
+class _Quote(object):
+
+    """ Body item pushing a function instead of calling it. """
+
+    __slots__ = ('function',)
+
+    def __init__(self, function):
+        self.function = function
+
+
+class _Missing(object):
+
+    """ Value of a field missing in an entry. """
+
+    __slots__ = ('name',)
+
+    def __init__(self, name):
+        self.name = name
+
+
+# value popped from an empty stack
+_EMPTY = _Missing('empty stack')
+
+
+class Style(object):
+
+    """ Parsed .bst file: functions and the list of commands to run. """
+
+    _cache = {}
+
+    def __init__(self, text):
+        """ Parse style text, raise StyleError if it is not valid. """
+        self.functions = {}
+        self.fields = []
+        self.entryInts = []
+        self.entryStrs = ['sort.key$']
+        self.globalInts = []
+        self.globalStrs = []
+        self.macros = {}
+        self.commands = []
+        self.errors = []
+        for name, method in Machine.builtins.items():
+            self.functions[name] = _Function(name, _BUILTIN, method)
+        self.functions['sort.key$'] = _Function('sort.key$', _ENTRY_STR)
+        self._parse(self._tree(text))
+        # machines that finished a run, see run
+        self.idle = []
+        self.lock = threading.Lock()
+
+    @classmethod
+    def get(cls, text):
+        """ Return parsed style, each text is parsed only once. """
+        style = cls._cache.get(text)
+        if style is None:
+            style = cls(text)
+            if len(cls._cache) >= 16:
+                cls._cache.clear()
+            cls._cache[text] = style
+        return style
+
+    def run(self, bib):
+        """
+        Run the style on bib and return the .bbl text.
+
+        Machines are reused by later runs, so that functions are compiled
+        only once, see Machine._code. Concurrent runs use separate machines.
+        """
+        with self.lock:
+            machine = self.idle.pop() if self.idle else None
+        if machine is None:
+            machine = Machine(self)
+        output = machine.run(bib)
+        with self.lock:
+            if len(self.idle) < _IDLE_MACHINES:
+                self.idle.append(machine)
+        return output
+
+    def _tree(self, text):
+        """ Return tokens of text, with brace groups as nested lists. """
+        stack = [[]]
+        for m in _BST_TOKEN.finditer(text):
+            kind = m.lastgroup
+            if kind is None:
+                continue
+            value = m.group(kind)
+            if kind == 'brace':
+                if value == '{':
+                    stack.append([])
+                elif len(stack) > 1:
+                    group = stack.pop()
+                    stack[-1].append(group)
+                else:
+                    raise StyleError('unbalanced }')
+            elif kind == 'bad':
+                raise StyleError('unexpected %r' % value)
+            else:
+                if kind == 'int':
+                    value = int(value)
+                elif kind in ('name', 'quote'):
+                    value = value.lower()
+                stack[-1].append((kind, value))
+        if len(stack) > 1:
+            raise StyleError('unbalanced {')
+        return stack[0]
+
+    def _names(self, group):
+        """ Return names listed in a brace group. """
+        if not isinstance(group, list) or \
+                any(isinstance(t, list) or t[0] != 'name' for t in group):
+            raise StyleError('expected a list of names')
+        return [t[1] for t in group]
+
+    def _define(self, name, kind, value=None):
+        """ Add a new name to the style. """
+        if name in self.functions:
+            raise StyleError(name + ' is already defined')
+        self.functions[name] = function = _Function(name, kind, value)
+        return function
+
+    def _parse(self, tree):
+        """ Process commands of the style. """
+        arguments = {'entry': 3, 'integers': 1, 'strings': 1, 'function': 2,
+                     'macro': 2, 'read': 0, 'execute': 1, 'iterate': 1,
+                     'reverse': 1, 'sort': 0}
+        i = 0
+        while i < len(tree):
+            token = tree[i]
+            if isinstance(token, list) or token[0] != 'name' or \
+                    token[1] not in arguments:
+                raise StyleError('expected a command, got %r' % (token,))
+            command = token[1]
+            args = tree[i + 1:i + 1 + arguments[command]]
+            i += 1 + arguments[command]
+            if len(args) < arguments[command] or \
+                    any(not isinstance(a, list) for a in args):
+                raise StyleError(command + ' needs brace groups')
+            if command == 'entry':
+                for name in self._names(args[0]) + ['crossref']:
+                    if name not in self.functions:
+                        self.fields.append(name)
+                        self._define(name, _FIELD, _Missing(name))
+                for name in self._names(args[1]):
+                    self.entryInts.append(name)
+                    self._define(name, _ENTRY_INT)
+                for name in self._names(args[2]):
+                    self.entryStrs.append(name)
+                    self._define(name, _ENTRY_STR)
+            elif command == 'integers':
+                for name in self._names(args[0]):
+                    self.globalInts.append(name)
+                    self._define(name, _GLOBAL_INT)
+            elif command == 'strings':
+                for name in self._names(args[0]):
+                    self.globalStrs.append(name)
+                    self._define(name, _GLOBAL_STR)
+            elif command == 'function':
+                name, = self._names(args[0])
+                if name in self.functions:
+                    # bibtex complains and skips the command
+                    self.errors.append(name + ' is already defined')
+                    continue
+                # defined before the body, so that it can call itself
+                function = self._define(name, _USER)
+                function.value = self._compile(args[1])
+            elif command == 'macro':
+                name, = self._names(args[0])
+                if len(args[1]) != 1 or isinstance(args[1][0], list) or \
+                        args[1][0][0] != 'str':
+                    raise StyleError('macro ' + name + ' needs a string')
+                self.macros[name] = args[1][0][1]
+            elif command in ('read', 'sort'):
+                self.commands.append((command, None))
+            else:
+                name, = self._names(args[0])
+                if name not in self.functions:
+                    raise StyleError('unknown function ' + name)
+                self.commands.append((command, self.functions[name]))
+
+    def _compile(self, group):
+        """ Turn function body into a list of items for Machine._call. """
+        body = []
+        for token in group:
+            if isinstance(token, list):
+                # inline function is pushed, e.g. by if$ branches
+                body.append(_Quote(_Function('{}', _USER,
+                                             self._compile(token))))
+                continue
+            kind, value = token
+            if kind in ('int', 'str'):
+                body.append(value)
+            elif value not in self.functions:
+                raise StyleError('unknown function ' + value)
+            elif kind == 'quote':
+                body.append(_Quote(self.functions[value]))
+            else:
+                body.append(self.functions[value])
+        return body
+
+
+class _Entry(object):
+
+    """ Database entry with values of fields and entry variables. """
+
+    __slots__ = ('key', 'type', 'fields', 'variables', 'index')
+
+    def __init__(self, key, entrytype, index):
+        self.key = key
+        self.type = entrytype
+        self.fields = {}
+        self.variables = None
+        self.index = index
+
+
+class Machine(object):
+
+    """ State of a run of a style, it can be run again on other data. """
+
+    # name of built-in function -> method
+    builtins = {}
+
+    def __init__(self, style):
+        """ Prepare to run style. """
+        self.style = style
+        self.stack = []
+        self.variables = {}
+        self.names = {}
+        # function -> callable executing it, see _code
+        self.code = {}
+        self.reset()
+
+    def reset(self):
+        """ Forget data and output of the last run. """
+        # compiled functions refer to the stack and the global variables
+        del self.stack[:]
+        self.variables.clear()
+        self.variables.update(dict.fromkeys(self.style.globalInts, 0))
+        self.variables.update(dict.fromkeys(self.style.globalStrs, ''))
+        self.entries = []
+        self.entry = None
+        self.preamble = []
+        self.lines = []
+        self.buffer = ''
+        self.warnings = []
+        self.errors = []
+        if len(self.names) > _NAMES:
+            self.names.clear()
+
+    def run(self, bib):
+        """ Execute the style commands on bib and return the .bbl text. """
+        self.reset()
+        if isinstance(bib, unicode):
+            bib = bib.encode('utf-8')
+        for command, function in self.style.commands:
+            if command == 'read':
+                self.read(bib)
+            elif command == 'execute':
+                self._top(function)
+            elif command == 'iterate':
+                for self.entry in self.entries:
+                    self._top(function)
+                self.entry = None
+            elif command == 'reverse':
+                for self.entry in self.entries[::-1]:
+                    self._top(function)
+                self.entry = None
+            elif command == 'sort':
+                # ties are broken by the order in the database
+                self.entries.sort(key=lambda e: (e.variables['sort.key$'],
+                                                 e.index))
+        if self.buffer:
+            self._newline()
+        return ''.join(self.lines)
+
+    def _top(self, function):
+        """ Call function from a command, the stack should end up empty. """
+        self._call(function)
+        if self.stack:
+            self._error('stack is not empty after ' + function.name)
+            del self.stack[:]
+
+    def _error(self, message):
+        """ Record an error, bibtex would print it to the log. """
+        self.errors.append(message)
+
+    # database
+
+    def read(self, bib):
+        """ Read all entries of a .bib file. """
+        macros = dict(self.style.macros)
+        fields = frozenset(self.style.fields)
+        seen = set()
+        pos = 0
+        while True:
+            pos = bib.find('@', pos)
+            if pos < 0:
+                break
+            m = _BIB_ID.match(bib, _BIB_SPACE.match(bib, pos + 1).end())
+            if not m:
+                pos += 1
+                continue
+            command = m.group().lower()
+            pos = _BIB_SPACE.match(bib, m.end()).end()
+            if command == 'comment' or bib[pos:pos + 1] not in ('{', '('):
+                continue
+            close = '}' if bib[pos] == '{' else ')'
+            pos += 1
+            try:
+                if command == 'preamble':
+                    value, pos = self._value(bib, pos, macros)
+                    self.preamble.append(value)
+                elif command == 'string':
+                    pos, name = self._id(bib, pos)
+                    pos = self._expect(bib, pos, '=')
+                    macros[name.lower()], pos = self._value(bib, pos, macros)
+                else:
+                    pos = _BIB_SPACE.match(bib, pos).end()
+                    m = _BIB_KEY['{' if close == '}' else '('].match(bib, pos)
+                    key = m.group()
+                    pos = m.end()
+                    if key.lower() in seen:
+                        self._error('repeated entry ' + key)
+                        continue
+                    seen.add(key.lower())
+                    entry = _Entry(key, command, len(self.entries))
+                    self.entries.append(entry)
+                    pos = self._fields(bib, pos, close, entry, fields, macros)
+            except (IndexError, ValueError) as e:
+                self._error('bad database entry: ' + str(e))
+        self._crossrefs()
+        strings = self.style.entryStrs
+        variables = dict.fromkeys(self.style.entryInts, 0)
+        variables.update(dict.fromkeys(strings, ''))
+        for entry in self.entries:
+            entry.variables = dict(variables)
+
+    def _fields(self, bib, pos, close, entry, fields, macros):
+        """ Read fields of entry, return position after the entry. """
+        while True:
+            pos = _BIB_SPACE.match(bib, pos).end()
+            if bib[pos] == close:
+                return pos + 1
+            pos = self._expect(bib, pos, ',')
+            pos = _BIB_SPACE.match(bib, pos).end()
+            if bib[pos] == close:
+                return pos + 1
+            pos, name = self._id(bib, pos)
+            name = name.lower()
+            pos = self._expect(bib, pos, '=')
+            value, pos = self._value(bib, pos, macros)
+            if name in fields and name not in entry.fields:
+                # the first of repeated fields is used
+                entry.fields[name] = value
+
+    def _id(self, bib, pos):
+        """ Read a name, return position after it and the name. """
+        m = _BIB_ID.match(bib, _BIB_SPACE.match(bib, pos).end())
+        if not m:
+            raise ValueError('expected a name at %d' % pos)
+        return m.end(), m.group()
+
+    def _expect(self, bib, pos, char):
+        """ Skip white space and char. """
+        pos = _BIB_SPACE.match(bib, pos).end()
+        if bib[pos] != char:
+            raise ValueError('expected %s at %d' % (char, pos))
+        return pos + 1
+
+    def _value(self, bib, pos, macros):
+        """ Read a field value, return it and the position after it. """
+        parts = []
+        while True:
+            pos = _BIB_SPACE.match(bib, pos).end()
+            char = bib[pos]
+            if char == '{' or char == '"':
+                level = 0
+                start = pos + 1
+                pos = start
+                while True:
+                    c = bib[pos]
+                    if c == '{':
+                        level += 1
+                    elif c == '}':
+                        if level == 0:
+                            if char == '{':
+                                break
+                            raise ValueError('unbalanced } at %d' % pos)
+                        level -= 1
+                    elif c == '"' and level == 0 and char == '"':
+                        break
+                    pos += 1
+                parts.append(bib[start:pos])
+                pos += 1
+            elif char.isdigit():
+                m = _BIB_NUMBER.match(bib, pos)
+                parts.append(m.group())
+                pos = m.end()
+            else:
+                pos, name = self._id(bib, pos)
+                name = name.lower()
+                if name not in macros:
+                    self._error('undefined string ' + name)
+                parts.append(macros.get(name, ''))
+            pos = _BIB_SPACE.match(bib, pos).end()
+            if bib[pos] != '#':
+                break
+            pos += 1
+        value = _BIB_WHITE.sub(' ', ''.join(parts)).strip(' ')
+        return value, pos
+
+    def _crossrefs(self):
+        """ Let entries inherit missing fields from cross-referenced ones. """
+        keys = dict((e.key.lower(), e) for e in self.entries)
+        for entry in self.entries:
+            crossref = entry.fields.get('crossref')
+            if crossref is None:
+                continue
+            parent = keys.get(crossref.lower())
+            if parent is None or parent is entry:
+                self._error('bad cross reference in ' + entry.key)
+                del entry.fields['crossref']
+                continue
+            for name, value in parent.fields.items():
+                if name != 'crossref':
+                    entry.fields.setdefault(name, value)
+
+    # execution
+
+    def _call(self, function):
+        """ Execute function. """
+        try:
+            code = self.code[function]
+        except KeyError:
+            code = self._code(function)
+        code()
+
+    def _code(self, function):
+        """ Return callable executing function on this machine. """
+        code = self.code.get(function)
+        if code is not None:
+            return code
+        kind = function.kind
+        push = self.stack.append
+        name = function.name
+        if kind is _USER:
+            ops = []
+
+            def code():
+                for op in ops:
+                    op()
+            # saved before the body, which can call the function itself
+            self.code[function] = code
+            items = function.value
+            i = 0
+            while i < len(items):
+                item = items[i]
+                op, used = self._fused(items, i)
+                if op is not None:
+                    ops.append(op)
+                    i += used
+                    continue
+                if type(item) is _Function:
+                    ops.append(self._code(item))
+                elif type(item) is _Quote:
+                    ops.append(partial(push, item.function))
+                else:
+                    ops.append(partial(push, item))
+                i += 1
+            if len(ops) == 1 and name == '{}':
+                # inline function can not call itself
+                code = self.code[function] = ops[0]
+            return code
+        if kind is _BUILTIN:
+            code = partial(function.value, self)
+        elif kind is _FIELD:
+            missing = function.value
+
+            def code():
+                push(self.entry.fields.get(name, missing))
+        elif kind is _ENTRY_INT or kind is _ENTRY_STR:
+            def code():
+                push(self.entry.variables[name])
+        else:
+            variables = self.variables
+
+            def code():
+                push(variables[name])
+        self.code[function] = code
+        return code
+
+    def _fused(self, items, i):
+        """
+        Return a single callable doing the work of items starting at i,
+        and the number of items it replaces, or (None, 0).
+
+        Quoted functions followed by if$ or while$, and a quoted variable
+        followed by := make up most of a style, and are not pushed at all.
+        """
+        names = [item.name if type(item) is _Function and
+                 item.kind is _BUILTIN else None for item in items[i:i + 3]]
+        if type(items[i]) is not _Quote:
+            return None, 0
+        if names[1:2] == [':='] and items[i].function.kind in _VARIABLES:
+            return self._assignment(items[i].function), 2
+        if names[2:] not in (['if$'], ['while$']) or \
+                type(items[i + 1]) is not _Quote:
+            return None, 0
+        first = self._code(items[i].function)
+        second = self._code(items[i + 1].function)
+        stack = self.stack
+        popInt = self._popInt
+        if names[2] == 'if$':
+            def op():
+                if stack and type(stack[-1]) is int:
+                    condition = stack.pop()
+                else:
+                    condition = popInt()
+                    if condition is None:
+                        return
+                if condition > 0:
+                    first()
+                else:
+                    second()
+        else:
+            def op():
+                while True:
+                    first()
+                    condition = popInt()
+                    if condition is None or condition <= 0:
+                        break
+                    second()
+        return op, 3
+
+    def _assignment(self, variable):
+        """ Return callable doing := with variable quoted. """
+        kind = variable.kind
+        name = variable.name
+        expected = _TYPES[kind]
+        size = {_ENTRY_STR: ENT_STR_SIZE, _GLOBAL_STR: GLOB_STR_SIZE}.get(kind)
+        entryVariable = kind is _ENTRY_INT or kind is _ENTRY_STR
+        variables = self.variables
+
+        def op():
+            value = self._pop()
+            if type(value) is not expected:
+                self._wrongType(value, 'integer' if expected is int
+                                else 'string')
+                return
+            if size is not None and len(value) > size:
+                self._error('value of %s is too long' % name)
+                value = value[:size]
+            if not entryVariable:
+                variables[name] = value
+            elif self.entry is None:
+                self._error('%s outside of an entry' % name)
+            else:
+                self.entry.variables[name] = value
+        return op
+
+    def _pop(self):
+        """ Pop any value. """
+        try:
+            return self.stack.pop()
+        except IndexError:
+            pass
+        self._error('pop from empty stack')
+        return _EMPTY
+
+    def _popStr(self):
+        """ Pop a string, or return None after an error. """
+        try:
+            value = self.stack.pop()
+        except IndexError:
+            value = self._pop()
+        if type(value) is str:
+            return value
+        self._wrongType(value, 'string')
+        return None
+
+    def _popInt(self):
+        """ Pop an integer, or return None after an error. """
+        try:
+            value = self.stack.pop()
+        except IndexError:
+            value = self._pop()
+        if type(value) is int:
+            return value
+        self._wrongType(value, 'integer')
+        return None
+
+    def _wrongType(self, value, expected):
+        """ Record a value of wrong type. """
+        if value is not _EMPTY:
+            self._error('%r is not %s' % (value, expected))
+
+    def _write(self, text):
+        """ Add text to the output, breaking long lines like bibtex. """
+        buf = self.buffer + text
+        while len(buf) > _MAX_PRINT_LINE:
+            # last white space at or before the maximal line length
+            i = _MAX_PRINT_LINE
+            while i >= _MIN_PRINT_LINE and buf[i] not in _WHITE:
+                i -= 1
+            if i < _MIN_PRINT_LINE:
+                # no white space, break at the first after the line end
+                i = _MAX_PRINT_LINE + 1
+                while i < len(buf) and buf[i] not in _WHITE:
+                    i += 1
+                if i == len(buf):
+                    break
+                while i + 1 < len(buf) and buf[i + 1] in _WHITE:
+                    i += 1
+            self.buffer = buf[:i]
+            self._newline()
+            buf = '  ' + buf[i + 1:]
+        self.buffer = buf
+
+    def _newline(self):
+        """ Write out the current line without trailing white space. """
+        line = self.buffer.rstrip(_WHITE)
+        if self.buffer and not line:
+            # a line of just white space is ignored
+            return
+        self.lines.append(line + '\n')
+        self.buffer = ''
+
+    # built-in functions, the last argument is at the top of the stack;
+    # the most used ones check the arguments in place first, and pop them
+    # one by one only when there is an error to report
+
+    def _greater(self):
+        stack = self.stack
+        if len(stack) > 1 and type(stack[-1]) is int is type(stack[-2]):
+            b = stack.pop()
+            stack[-1] = int(stack[-1] > b)
+            return
+        b, a = self._popInt(), self._popInt()
+        self.stack.append(int(a > b) if None not in (a, b) else 0)
+
+    def _less(self):
+        stack = self.stack
+        if len(stack) > 1 and type(stack[-1]) is int is type(stack[-2]):
+            b = stack.pop()
+            stack[-1] = int(stack[-1] < b)
+            return
+        b, a = self._popInt(), self._popInt()
+        self.stack.append(int(a < b) if None not in (a, b) else 0)
+
+    def _equal(self):
+        stack = self.stack
+        if len(stack) > 1 and type(stack[-1]) is type(stack[-2]) and \
+                type(stack[-1]) in (int, str):
+            b = stack.pop()
+            stack[-1] = int(stack[-1] == b)
+            return
+        b, a = self._pop(), self._pop()
+        if type(a) is type(b) and type(a) in (int, str):
+            self.stack.append(int(a == b))
+        else:
+            self._wrongType(b if type(b) not in (int, str) else a,
+                            'of the same type')
+            self.stack.append(0)
+
+    def _plus(self):
+        stack = self.stack
+        if len(stack) > 1 and type(stack[-1]) is int is type(stack[-2]):
+            b = stack.pop()
+            stack[-1] += b
+            return
+        b, a = self._popInt(), self._popInt()
+        self.stack.append(a + b if None not in (a, b) else 0)
+
+    def _minus(self):
+        stack = self.stack
+        if len(stack) > 1 and type(stack[-1]) is int is type(stack[-2]):
+            b = stack.pop()
+            stack[-1] -= b
+            return
+        b, a = self._popInt(), self._popInt()
+        self.stack.append(a - b if None not in (a, b) else 0)
+
+    def _concat(self):
+        stack = self.stack
+        if len(stack) > 1 and type(stack[-1]) is str is type(stack[-2]):
+            b = stack.pop()
+            stack[-1] += b
+            return
+        b, a = self._popStr(), self._popStr()
+        self.stack.append(a + b if None not in (a, b) else '')
+
+    def _assign(self):
+        variable, value = self._pop(), self._pop()
+        if type(variable) is not _Function or \
+                variable.kind not in _VARIABLES:
+            self._wrongType(variable, 'a variable')
+            return
+        kind = variable.kind
+        if type(value) is not _TYPES[kind]:
+            self._wrongType(value, 'integer' if _TYPES[kind] is int
+                            else 'string')
+            return
+        if kind is _ENTRY_STR or kind is _GLOBAL_STR:
+            size = ENT_STR_SIZE if kind is _ENTRY_STR else GLOB_STR_SIZE
+            if len(value) > size:
+                self._error('value of %s is too long' % variable.name)
+                value = value[:size]
+        if kind is _ENTRY_INT or kind is _ENTRY_STR:
+            if self.entry is None:
+                self._error('%s outside of an entry' % variable.name)
+                return
+            self.entry.variables[variable.name] = value
+        else:
+            self.variables[variable.name] = value
+
+    def _addPeriod(self):
+        s = self._popStr()
+        if s is None:
+            s = ''
+        elif s and s.rstrip('}')[-1:] not in ('.', '?', '!'):
+            s += '.'
+        self.stack.append(s)
+
+    def _callType(self):
+        if self.entry is None:
+            self._error('call.type$ outside of an entry')
+            return
+        function = self.style.functions.get(self.entry.type)
+        if function is None or function.kind is not _USER:
+            function = self.style.functions['default.type']
+        self._call(function)
+
+    def _changeCase(self):
+        mode, s = self._popStr(), self._popStr()
+        if s is None:
+            s = ''
+        elif mode is not None:
+            mode = mode.lower()
+            if mode in ('t', 'l', 'u'):
+                s = changeCase(s, mode)
+            else:
+                self._error('%r is an illegal case-conversion string' % mode)
+        self.stack.append(s)
+
+    def _chrToInt(self):
+        s = self._popStr()
+        if s is not None and len(s) != 1:
+            self._error('%r is not a single character' % s)
+            s = None
+        self.stack.append(ord(s) if s is not None else 0)
+
+    def _cite(self):
+        self.stack.append(self.entry.key if self.entry is not None else '')
+
+    def _duplicate(self):
+        if self.stack:
+            self.stack.append(self.stack[-1])
+            return
+        value = self._pop()
+        self.stack.append(value)
+        if value is not _EMPTY:
+            self.stack.append(value)
+
+    def _empty(self):
+        stack = self.stack
+        if stack and type(stack[-1]) is str:
+            stack[-1] = int(not stack[-1].strip(_WHITE))
+            return
+        value = self._pop()
+        if type(value) is str:
+            self.stack.append(int(not value.strip(_WHITE)))
+        elif type(value) is _Missing and value is not _EMPTY:
+            self.stack.append(1)
+        else:
+            self._wrongType(value, 'string')
+            self.stack.append(0)
+
+    def _formatName(self):
+        fmt, n, names = self._popStr(), self._popInt(), self._popStr()
+        if None in (fmt, n, names):
+            self.stack.append('')
+            return
+        split = self._names(names)
+        if not split or n < 1:
+            self._error('there is no name %d in %r' % (n, names))
+            self.stack.append('')
+            return
+        if n > len(split):
+            self._error('there are not %d names in %r' % (n, names))
+            n = len(split)
+        name = split[n - 1]
+        if not isinstance(name, _Name):
+            name = split[n - 1] = _Name(name)
+        self.stack.append(formatName(name, fmt))
+
+    def _names(self, names):
+        """ Split names, the same names are formatted many times. """
+        split = self.names.get(names)
+        if split is None:
+            # parsed into _Name when formatted
+            split = self.names[names] = splitNames(names)
+        return split
+
+    def _if(self):
+        stack = self.stack
+        if len(stack) >= 3 and type(stack[-3]) is int:
+            # the usual case, checked without popping one by one
+            orelse, then, condition = stack.pop(), stack.pop(), stack.pop()
+        else:
+            orelse, then, condition = self._pop(), self._pop(), self._popInt()
+        if type(then) is not _Function or type(orelse) is not _Function:
+            self._wrongType(then, 'a function')
+        elif condition is not None:
+            function = then if condition > 0 else orelse
+            try:
+                code = self.code[function]
+            except KeyError:
+                code = self._code(function)
+            code()
+
+    def _intToChr(self):
+        n = self._popInt()
+        if n is not None and not 0 <= n < 128:
+            self._error('%d is not a character code' % n)
+            n = None
+        self.stack.append(chr(n) if n is not None else '')
+
+    def _intToStr(self):
+        n = self._popInt()
+        self.stack.append(str(n) if n is not None else '')
+
+    def _missing(self):
+        value = self._pop()
+        if type(value) is str:
+            self.stack.append(0)
+        elif type(value) is _Missing and value is not _EMPTY:
+            self.stack.append(1)
+        else:
+            self._wrongType(value, 'string')
+            self.stack.append(0)
+
+    def _newlineBuiltin(self):
+        self._newline()
+
+    def _numNames(self):
+        names = self._popStr()
+        self.stack.append(len(self._names(names)) if names is not None else 0)
+
+    def _popBuiltin(self):
+        self._pop()
+
+    def _preamble(self):
+        self.stack.append(''.join(self.preamble))
+
+    def _purify(self):
+        s = self._popStr()
+        self.stack.append(purify(s) if s is not None else '')
+
+    def _quote(self):
+        self.stack.append('"')
+
+    def _skip(self):
+        pass
+
+    def _stackBuiltin(self):
+        del self.stack[:]
+
+    def _substring(self):
+        length, start, s = self._popInt(), self._popInt(), self._popStr()
+        if None in (length, start, s):
+            self.stack.append('')
+            return
+        self.stack.append(substring(s, start, length))
+
+    def _swap(self):
+        b, a = self._pop(), self._pop()
+        self.stack.append(b)
+        self.stack.append(a)
+
+    def _textLength(self):
+        s = self._popStr()
+        self.stack.append(textLength(s) if s is not None else 0)
+
+    def _textPrefix(self):
+        n, s = self._popInt(), self._popStr()
+        self.stack.append(textPrefix(s, n) if None not in (n, s) else '')
+
+    def _type(self):
+        entry = self.entry
+        if entry is None or entry.type not in self.style.functions or \
+                self.style.functions[entry.type].kind is not _USER:
+            self.stack.append('')
+        else:
+            self.stack.append(entry.type)
+
+    def _warning(self):
+        s = self._popStr()
+        if s is not None:
+            self.warnings.append(s)
+
+    def _while(self):
+        body, condition = self._pop(), self._pop()
+        if type(body) is not _Function or type(condition) is not _Function:
+            self._wrongType(body, 'a function')
+            return
+        while True:
+            self._call(condition)
+            value = self._popInt()
+            if value is None or value <= 0:
+                break
+            self._call(body)
+
+    def _width(self):
+        s = self._popStr()
+        self.stack.append(width(s) if s is not None else 0)
+
+    def _writeBuiltin(self):
+        s = self._popStr()
+        if s is not None:
+            self._write(s)
+
+    def _entryMax(self):
+        self.stack.append(ENT_STR_SIZE)
+
+    def _globalMax(self):
+        self.stack.append(GLOB_STR_SIZE)
+
+
+Machine.builtins.update({
+    '>': Machine._greater, '<': Machine._less, '=': Machine._equal,
+    '+': Machine._plus, '-': Machine._minus, '*': Machine._concat,
+    ':=': Machine._assign, 'add.period$': Machine._addPeriod,
+    'call.type$': Machine._callType, 'change.case$': Machine._changeCase,
+    'chr.to.int$': Machine._chrToInt, 'cite$': Machine._cite,
+    'duplicate$': Machine._duplicate, 'empty$': Machine._empty,
+    'entry.max$': Machine._entryMax, 'format.name$': Machine._formatName,
+    'global.max$': Machine._globalMax, 'if$': Machine._if,
+    'int.to.chr$': Machine._intToChr, 'int.to.str$': Machine._intToStr,
+    'missing$': Machine._missing, 'newline$': Machine._newlineBuiltin,
+    'num.names$': Machine._numNames, 'pop$': Machine._popBuiltin,
+    'preamble$': Machine._preamble, 'purify$': Machine._purify,
+    'quote$': Machine._quote, 'skip$': Machine._skip,
+    'stack$': Machine._stackBuiltin, 'substring$': Machine._substring,
+    'swap$': Machine._swap, 'text.length$': Machine._textLength,
+    'text.prefix$': Machine._textPrefix, 'top$': Machine._popBuiltin,
+    'type$': Machine._type, 'warning$': Machine._warning,
+    'while$': Machine._while, 'width$': Machine._width,
+    'write$': Machine._writeBuiltin,
+})
+
+
+# string functions
+
+def _special(s, i):
+    """ True if s has a special character, e.g. {\\'e}, starting at i. """
+    return s[i] == '{' and s[i + 1:i + 2] == '\\'
+
+
+def _groupEnd(s, i, level=1):
+    """ Index after the brace group containing i, at the given level. """
+    n = len(s)
+    while i < n and level > 0:
+        c = s[i]
+        if c == '{':
+            level += 1
+        elif c == '}':
+            level -= 1
+        i += 1
+    return i
+
+
+def _controlSequence(s, i):
+    """ Return name of control sequence starting at i and the end. """
+    j = i
+    while j < len(s) and s[j] in _ALPHA:
+        j += 1
+    return s[i:j], j
+
+
+def purify(s):
+    """ purify$: keep letters, digits and spaces, strip special letters. """
+    if '{' not in s and '}' not in s:
+        return s.translate(_PURIFY, _PURIFY_DELETE)
+    out = []
+    i = 0
+    n = len(s)
+    level = 0
+    while i < n:
+        c = s[i]
+        if c in _WHITE or c in _SEP:
+            out.append(' ')
+        elif c in _ALNUM:
+            out.append(c)
+        elif c == '{':
+            level += 1
+            if level == 1 and _special(s, i):
+                i += 1
+                while i < n and level > 0:
+                    # at a backslash
+                    name, i = _controlSequence(s, i + 1)
+                    if name in _SPECIAL:
+                        out.append(name[:2] if name in ('oe', 'OE', 'ae', 'AE',
+                                                        'ss') else name[0])
+                    while i < n and level > 0 and s[i] != '\\':
+                        c = s[i]
+                        if c in _ALNUM:
+                            out.append(c)
+                        elif c == '}':
+                            level -= 1
+                        elif c == '{':
+                            level += 1
+                        i += 1
+                continue
+        elif c == '}':
+            if level > 0:
+                level -= 1
+        i += 1
+    return ''.join(out)
+
+
+def changeCase(s, mode):
+    """ change.case$ with mode "t" (title), "l" (lower) or "u" (upper). """
+    if '{' not in s and '}' not in s:
+        if mode == 'l':
+            return s.translate(_TO_LOWER)
+        if mode == 'u':
+            return s.translate(_TO_UPPER)
+        if ':' not in s:
+            return s[:1] + s[1:].translate(_TO_LOWER)
+    convert = _TO_UPPER if mode == 'u' else _TO_LOWER
+    out = []
+    i = 0
+    n = len(s)
+    level = 0
+    colon = False
+    while i < n:
+        c = s[i]
+        if c == '{':
+            level += 1
+            kept = mode == 't' and (
+                i == 0 or (colon and s[i - 1] in _WHITE))
+            colon = False
+            if level != 1 or i + 4 > n or s[i + 1] != '\\' or kept:
+                out.append(c)
+                i += 1
+                continue
+            # special character, convert letters of the whole group
+            out.append(c)
+            i += 1
+            while i < n and level > 0:
+                # at a backslash
+                name, j = _controlSequence(s, i + 1)
+                if name in _SPECIAL:
+                    if mode != 'u':
+                        if name in _SPECIAL_UPPER:
+                            name = name.lower()
+                    elif name in ('i', 'j', 'ss'):
+                        # {\ss} becomes {SS}
+                        name = name.upper()
+                        while j < n and s[j] == ' ':
+                            j += 1
+                        out.append(name)
+                        name = None
+                    else:
+                        name = name.upper()
+                if name is not None:
+                    out.append('\\' + name)
+                i = j
+                while j < n and level > 0 and s[j] != '\\':
+                    if s[j] == '}':
+                        level -= 1
+                    elif s[j] == '{':
+                        level += 1
+                    j += 1
+                out.append(s[i:j].translate(convert))
+                i = j
+            continue
+        elif c == '}':
+            if level > 0:
+                level -= 1
+            colon = False
+        elif level == 0:
+            if mode != 't':
+                c = c.translate(convert)
+            else:
+                if i != 0 and not (colon and s[i - 1] in _WHITE):
+                    c = c.translate(convert)
+                if c == ':':
+                    colon = True
+                elif c not in _WHITE:
+                    colon = False
+        out.append(c)
+        i += 1
+    return ''.join(out)
+
+
+def substring(s, start, length):
+    """ substring$, negative start counts from the end. """
+    n = len(s)
+    if length >= n and start in (1, -1):
+        return s
+    if length <= 0 or start == 0 or start > n or start < -n:
+        return ''
+    if start > 0:
+        return s[start - 1:start - 1 + min(length, n - start + 1)]
+    end = n + start + 1
+    return s[max(end - length, 0):end]
+
+
+def _textChars(s, limit=None):
+    """ Count text characters (limited to limit), return count and end. """
+    i = 0
+    n = len(s)
+    count = 0
+    level = 0
+    while i < n and (limit is None or count < limit):
+        c = s[i]
+        i += 1
+        if c == '{':
+            level += 1
+            if level == 1 and s[i:i + 1] == '\\':
+                # special character counts as one
+                i = _groupEnd(s, i + 1)
+                level = 0
+                count += 1
+        elif c == '}':
+            if level > 0:
+                level -= 1
+        else:
+            count += 1
+    return count, i, level
+
+
+def textLength(s):
+    """ text.length$: number of characters, special ones count as one. """
+    if '{' not in s and '}' not in s:
+        return len(s)
+    return _textChars(s)[0]
+
+
+def textPrefix(s, n):
+    """ text.prefix$: first n characters, with braces closed. """
+    if n <= 0:
+        return ''
+    count, end, level = _textChars(s, n)
+    return s[:end] + '}' * level
+
+
+def width(s):
+    """ width$: width of s in cmr10. """
+    total = 0
+    i = 0
+    n = len(s)
+    level = 0
+    while i < n:
+        c = s[i]
+        if c == '{':
+            level += 1
+            if level == 1 and _special(s, i):
+                i += 1
+                while i < n and level > 0:
+                    name, i = _controlSequence(s, i + 1)
+                    if not name and i < n:
+                        # control symbol, e.g. \'
+                        name = s[i]
+                        i += 1
+                    total += _SPECIAL_WIDTHS.get(name, _WIDTHS.get(name[:1],
+                                                                   0))
+                    while i < n and s[i] in _WHITE:
+                        i += 1
+                    while i < n and level > 0 and s[i] != '\\':
+                        if s[i] == '}':
+                            level -= 1
+                        elif s[i] == '{':
+                            level += 1
+                        else:
+                            total += _WIDTHS.get(s[i], 0)
+                        i += 1
+                continue
+            total += _WIDTHS['{']
+        elif c == '}':
+            if level > 0:
+                level -= 1
+            total += _WIDTHS['}']
+        else:
+            total += _WIDTHS.get(c, 0)
+        i += 1
+    return total
+
+
+# names
+
+def splitNames(s):
+    """ Split names separated by "and" at brace level 0. """
+    if not s:
+        return []
+    names = []
+    start = 0
+    i = 0
+    n = len(s)
+    white = False
+    while i < n:
+        c = s[i]
+        i += 1
+        if c == 'a' or c == 'A':
+            if white and i <= n - 3 and s[i] in 'nN' and s[i + 1] in 'dD' \
+                    and s[i + 2] in _WHITE:
+                names.append(s[start:i - 2])
+                i += 2
+                start = i
+            white = False
+        elif c == '{':
+            i = _groupEnd(s, i)
+            white = False
+        else:
+            white = c in _WHITE
+    names.append(s[start:])
+    return names
+
+
+class _Name(object):
+
+    """ Tokens of a name, and where the first, von, last and jr parts are. """
+
+    __slots__ = ('tokens', 'seps', 'parts')
+
+    def __init__(self, name):
+        """ Break the name into tokens and parts, like bibtex does. """
+        name = name.rstrip(_WHITE + _SEP + ',')
+        tokens = []
+        seps = []  # character before each token
+        commas = []
+        sep = ''
+        starting = True
+        i = 0
+        n = len(name)
+        while i < n:
+            c = name[i]
+            if c == ',':
+                if len(commas) < 2:
+                    commas.append(len(tokens))
+                    sep = ','
+                starting = True
+                i += 1
+            elif c in _WHITE or c in _SEP:
+                if not starting:
+                    sep = ' ' if c in _WHITE else c
+                starting = True
+                i += 1
+            else:
+                if c == '{':
+                    j = _groupEnd(name, i + 1)
+                elif c == '}':
+                    j = i + 1
+                    c = ''
+                else:
+                    j = i + 1
+                if starting:
+                    tokens.append('')
+                    seps.append(sep)
+                    sep = ''
+                tokens[-1] += name[i:j] if c else ''
+                starting = False
+                i = j
+        self.tokens = tokens
+        self.seps = seps
+        count = len(tokens)
+        if not commas:
+            lastEnd = jrEnd = count
+            firstStart = 0
+            vonStart = 0
+            while vonStart < lastEnd - 1:
+                if _isVon(tokens[vonStart]):
+                    vonEnd = self._vonEnd(vonStart, lastEnd)
+                    break
+                vonStart += 1
+            else:
+                # no von part, last name includes hyphenated tokens
+                while vonStart > 0:
+                    if seps[vonStart] not in _SEP or seps[vonStart] == '~':
+                        break
+                    vonStart -= 1
+                vonEnd = vonStart
+            firstEnd = vonStart
+        else:
+            vonStart = 0
+            lastEnd = commas[0]
+            jrEnd = commas[1] if len(commas) > 1 else lastEnd
+            firstStart, firstEnd = jrEnd, count
+            vonEnd = self._vonEnd(vonStart, lastEnd)
+        self.parts = {'f': (firstStart, firstEnd), 'v': (vonStart, vonEnd),
+                      'l': (vonEnd, lastEnd), 'j': (lastEnd, jrEnd)}
+
+    def _vonEnd(self, vonStart, lastEnd):
+        """ End of the von part, the last name has at least one token. """
+        vonEnd = lastEnd - 1
+        while vonEnd > vonStart:
+            if _isVon(self.tokens[vonEnd - 1]):
+                break
+            vonEnd -= 1
+        return vonEnd
+
+
+def _isVon(token):
+    """ True if the first letter of token is in lower case. """
+    i = 0
+    n = len(token)
+    while i < n:
+        c = token[i]
+        if c in _UPPER:
+            return False
+        if c in _LOWER:
+            return True
+        if c == '{':
+            i += 1
+            if i + 2 < n and token[i] == '\\':
+                name, i = _controlSequence(token, i + 1)
+                if name in _SPECIAL:
+                    return name not in _SPECIAL_UPPER
+                level = 1
+                while i < n and level > 0:
+                    c = token[i]
+                    if c in _UPPER:
+                        return False
+                    if c in _LOWER:
+                        return True
+                    if c == '}':
+                        level -= 1
+                    elif c == '{':
+                        level += 1
+                    i += 1
+                return False
+            i = _groupEnd(token, i)
+        else:
+            i += 1
+    return False
+
+
+def _enough(s, enough):
+    """
+    True if s has at least enough characters.
+
+    Unlike in text.length$, braces are counted too.
+    """
+    count = 0
+    i = 0
+    n = len(s)
+    level = 0
+    while i < n and count < enough:
+        c = s[i]
+        i += 1
+        if c == '{':
+            level += 1
+            if level == 1 and s[i:i + 1] == '\\':
+                i = _groupEnd(s, i + 1)
+                level = 0
+        elif c == '}':
+            level -= 1
+        count += 1
+    return count >= enough
+
+
+def _initial(token):
+    """ First letter of token, or the whole special character. """
+    i = 0
+    n = len(token)
+    while i < n:
+        c = token[i]
+        if c in _ALPHA:
+            return c
+        if c == '{' and i + 1 < n and token[i + 1] == '\\':
+            return token[i:_groupEnd(token, i + 1)]
+        i += 1
+    return ''
+
+
+_formats = {}
+
+
+def _parseFormat(fmt):
+    """
+    Split name format into literal strings and part tuples.
+
+    A part is (pre, letter, full, between, post), between is None if
+    the default string between tokens should be used.
+    """
+    pieces = _formats.get(fmt)
+    if pieces is not None:
+        return pieces
+    pieces = []
+    i = 0
+    n = len(fmt)
+    while i < n:
+        c = fmt[i]
+        if c != '{':
+            if c != '}':
+                pieces.append(c)
+            i += 1
+            continue
+        end = _groupEnd(fmt, i + 1)
+        group = fmt[i + 1:end - 1]
+        i = end
+        # a part has exactly one group of letters at brace level 1
+        letters = []
+        j = 0
+        while j < len(group):
+            if group[j] in _ALPHA:
+                start = j
+                while j < len(group) and group[j] in _ALPHA:
+                    j += 1
+                letters.append((start, j))
+            elif group[j] == '{':
+                j = _groupEnd(group, j + 1)
+            else:
+                j += 1
+        if len(letters) != 1:
+            continue
+        start, j = letters[0]
+        word = group[start:j].lower()
+        if word[0] not in 'fvlj' or len(word) > 2 or \
+                (len(word) == 2 and word[1] != word[0]):
+            continue
+        between = None
+        post = j
+        if group[j:j + 1] == '{':
+            post = _groupEnd(group, j + 1)
+            between = group[j + 1:post - 1]
+        strip = lambda text: re.sub(r'\{[^{}]*\}|[{}]', '', text)
+        pieces.append((strip(group[:start]), word[0], len(word) == 2,
+                       between, strip(group[post:])))
+    if len(_formats) < 100:
+        _formats[fmt] = pieces
+    return pieces
+
+
+def formatName(name, fmt):
+    """ format.name$ of a single name. """
+    if not isinstance(name, _Name):
+        name = _Name(name)
+    out = []
+    for piece in _parseFormat(fmt):
+        if type(piece) is str:
+            out.append(piece)
+            continue
+        pre, letter, full, between, post = piece
+        first, last = name.parts[letter]
+        if first >= last:
+            continue
+        part = [pre]
+        for k in range(first, last):
+            token = name.tokens[k] if full else _initial(name.tokens[k])
+            part.append(token)
+            if k + 1 == last:
+                break
+            if between is not None:
+                part.append(between)
+                continue
+            if not full:
+                part.append('.')
+            sep = name.seps[k + 1]
+            if sep in _SEP:
+                part.append(sep)
+            elif k + 2 == last or not _enough(''.join(part), _LONG_TOKEN):
+                part.append('~')
+            else:
+                part.append(' ')
+        part.append(post)
+        part = ''.join(part)
+        if part.endswith('~~'):
+            part = part[:-1]
+        elif part.endswith('~'):
+            # discretionary tie is kept only after short parts
+            part = part[:-1]
+            part += ' ' if _enough(part, _LONG_NAME) else '~'
+        out.append(part)
+    return ''.join(out)
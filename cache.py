@@ -0,0 +1,231 @@
+""" Persistent cache of downloaded pages and search results. """
+
+import os
+import sqlite3
+import sys
+import threading
+import time
+import urllib
+import urlparse
+import zlib
+from collections import OrderedDict
+
+
+def _cacheDirectory():
+    """ Per-user cache folder, the app bundle may be read-only. """
+    if sys.platform == 'darwin':
+        return os.path.expanduser('~/Library/Caches/Cite')
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    return os.path.join(base, 'cite')
+
+
+_PATH = os.path.join(_cacheDirectory(), 'cache.sqlite')
+_MAX_BYTES = 50 * 2**20  # default size cap of all compressed bodies
+
+
+def normalizeUrl(url):
+    """ Turn url into a canonical cache key. """
+    parts = urlparse.urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    host = parts.netloc.lower()
+    if (scheme, host[-3:]) == ('http', ':80') or \
+            (scheme, host[-4:]) == ('https', ':443'):
+        host = host.rsplit(':', 1)[0]
+    # order of parameters does not change the response
+    query = sorted(urlparse.parse_qsl(parts.query, keep_blank_values=True))
+    return urlparse.urlunsplit((scheme, host, parts.path or '/',
+                                urllib.urlencode(query), ''))
+
+
+class DiskCache(object):
+
+    """
+    SQLite table of compressed strings with expiry and LRU eviction.
+
+    Each thread uses its own database connection. SQLite locking makes the
+    store safe to share between threads and between cite.py processes.
+    Any database error is treated as a cache miss.
+    """
+
+    def __init__(self, table, share=1.0, path=_PATH):
+        """
+        Set location and size cap. Database is opened lazily.
+
+        share is the part of the total cache size used by this table.
+        """
+        self.table = table
+        self.share = share
+        self.path = path
+        self.maxBytes = int(share * _MAX_BYTES)
+        self.local = threading.local()
+
+    def _db(self):
+        """ Return connection for the current thread. """
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            folder = os.path.dirname(self.path)
+            if not os.path.isdir(folder):
+                try:
+                    os.makedirs(folder)
+                except OSError:
+                    # created by another thread, or sqlite3 fails below
+                    pass
+            db = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            try:
+                # readers do not block the writer
+                db.execute('PRAGMA journal_mode=WAL')
+            except sqlite3.Error:
+                pass
+            # rows removed by INSERT OR REPLACE fire the delete trigger
+            db.execute('PRAGMA recursive_triggers = ON')
+            self._create(db)
+            self.local.db = db
+        return db
+
+    def _create(self, db):
+        """ Create the table, and triggers keeping its size in sizes. """
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            for sql in ('CREATE TABLE IF NOT EXISTS {0} ('
+                        'key TEXT PRIMARY KEY, body BLOB, size INTEGER, '
+                        'expires REAL, used REAL)',
+                        'CREATE INDEX IF NOT EXISTS {0}_used ON {0} (used)',
+                        'CREATE TABLE IF NOT EXISTS sizes ('
+                        'name TEXT PRIMARY KEY, total INTEGER)',
+                        "INSERT OR IGNORE INTO sizes SELECT '{0}', "
+                        'COALESCE(SUM(size), 0) FROM {0}',
+                        'CREATE TRIGGER IF NOT EXISTS {0}_insert '
+                        'AFTER INSERT ON {0} BEGIN UPDATE sizes SET '
+                        "total = total + new.size WHERE name = '{0}'; END",
+                        'CREATE TRIGGER IF NOT EXISTS {0}_delete '
+                        'AFTER DELETE ON {0} BEGIN UPDATE sizes SET '
+                        "total = total - old.size WHERE name = '{0}'; END"):
+                self._execute(db, sql)
+            db.execute('COMMIT')
+        except sqlite3.Error:
+            db.execute('ROLLBACK')
+            raise
+        return db
+
+    def _execute(self, db, sql, args=()):
+        """ Run sql with {0} replaced by the table name. """
+        return db.execute(sql.format(self.table), args)
+
+    def get(self, key):
+        """ Return cached body for key or None. """
+        if self.maxBytes <= 0:
+            return None
+        now = time.time()
+        try:
+            db = self._db()
+            row = self._execute(db, 'SELECT body, expires FROM {0} '
+                                'WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            if row[1] < now:
+                self._execute(db, 'DELETE FROM {0} WHERE key = ?', (key,))
+                return None
+            self._execute(db, 'UPDATE {0} SET used = ? WHERE key = ?',
+                          (now, key))
+            return zlib.decompress(str(row[0]))
+        except (sqlite3.Error, zlib.error):
+            return None
+
+    def put(self, key, body, ttl):
+        """ Store body for ttl seconds. """
+        if self.maxBytes <= 0:
+            return
+        data = zlib.compress(body)
+        now = time.time()
+        try:
+            db = self._db()
+            self._execute(db, 'INSERT OR REPLACE INTO {0} '
+                          'VALUES (?, ?, ?, ?, ?)',
+                          (key, sqlite3.Binary(data), len(data), now + ttl,
+                           now))
+            self._evict(db)
+        except sqlite3.Error:
+            pass
+
+    def _evict(self, db):
+        """ Remove expired and least recently used entries above the cap. """
+        total = self._execute(db, "SELECT total FROM sizes "
+                              "WHERE name = '{0}'").fetchone()
+        if total is None or total[0] <= self.maxBytes:
+            return
+        self._execute(db, 'DELETE FROM {0} WHERE expires < ?', (time.time(),))
+        total = self._execute(db, "SELECT total FROM sizes "
+                              "WHERE name = '{0}'").fetchone()[0]
+        if total <= self.maxBytes:
+            return
+        # free a bit more than necessary, so we do not evict on every put
+        excess = total - 0.9 * self.maxBytes
+        old = []
+        for key, size in self._execute(db, 'SELECT key, size FROM {0} '
+                                       'ORDER BY used'):
+            old.append((key,))
+            excess -= size
+            if excess <= 0:
+                break
+        db.executemany('DELETE FROM {0} WHERE key = ?'.format(self.table), old)
+
+    def delete(self, key):
+        """ Remove entry for key, if any. """
+        try:
+            self._execute(self._db(), 'DELETE FROM {0} WHERE key = ?', (key,))
+        except sqlite3.Error:
+            pass
+
+    def clear(self):
+        """ Remove all entries. """
+        try:
+            self._execute(self._db(), 'DELETE FROM {0}')
+        except sqlite3.Error:
+            pass
+
+
+class LRUCache(object):
+
+    """ Thread-safe in-memory mapping keeping the most recently used items. """
+
+    def __init__(self, size):
+        """ Keep at most size items. """
+        self.size = size
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """ Return value for key or None. """
+        with self.lock:
+            value = self.items.pop(key, None)
+            if value is not None:
+                # move to the end of the queue
+                self.items[key] = value
+            return value
+
+    def put(self, key, value):
+        """ Store value, forget the least recently used item if full. """
+        with self.lock:
+            self.items.pop(key, None)
+            self.items[key] = value
+            if len(self.items) > self.size:
+                self.items.popitem(last=False)
+
+
+# downloaded pages, keyed by normalized url
+responses = DiskCache('responses', 0.6)
+# cleaned up search results, keyed by fetcher and canonical query
+results = DiskCache('results', 0.2)
+# formatted references, keyed by fetch.formatKey
+formatted = DiskCache('formatted', 0.2)
+
+
+def configure(settings):
+    """ Apply cache size from settings (in MB, 0 disables caching). """
+    try:
+        size = int(settings['cacheSize']) * 2**20
+    except (KeyError, TypeError, ValueError):
+        return
+    # tables share the size, so together they stay below it
+    for table in (responses, results, formatted):
+        table.maxBytes = int(table.share * size)
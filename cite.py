@@ -3,16 +3,23 @@
 Main application script.
 
 Starts terminal version if any parameters or stdin input present.
+Terminal lookups are done by the daemon if it is running.
+With --daemon starts the daemon (see citeDaemon).
 Otherwise starts GUI.
 """
 from __future__ import division
 import sys
 
 
-if len(sys.argv) > 1 or not sys.stdin.isatty():
+if sys.argv[1:] == ['--daemon']:
+    from citeDaemon import serve
+    sys.exit(serve())
+elif len(sys.argv) > 1 or not sys.stdin.isatty():
     # start terminal
-    from citeTerminal import startTerminal
-    startTerminal()
+    from citeDaemon import request
+    if not request(sys.argv[1:]):
+        from citeTerminal import startTerminal
+        startTerminal()
 else:
     # start GUI
     from citeWindow import startApp
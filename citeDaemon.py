@@ -0,0 +1,223 @@
+"""
+Long running lookup server for the terminal interface.
+
+Started with cite.py --daemon, it listens on a Unix socket in a per-user
+folder. cite.py sends its arguments and standard input to the daemon if it
+is running, so that connections, caches and settings stay warm between
+lookups. Without the daemon cite.py does the lookup itself.
+
+Protocol: the client sends a JSON object with args (command line
+arguments) and stdin (standard input or null), and closes its side of the
+connection. The daemon answers with "1" followed by the text to print, or
+just "0" if there is nothing to print. An empty answer means the lookup
+failed in the daemon.
+
+The client part is imported by every cite.py call, so the server imports
+everything else only when started.
+"""
+
+import errno
+import json
+import os
+import socket
+import sys
+
+
+def _runtimeDirectory():
+    """
+    Per-user folder for the socket, the script folder may be read-only.
+
+    Without XDG_RUNTIME_DIR this is the folder of cache.sqlite, see
+    cache._cacheDirectory. cache itself is slow to import for every call.
+    """
+    if os.environ.get('XDG_RUNTIME_DIR'):
+        return os.environ['XDG_RUNTIME_DIR']
+    if sys.platform == 'darwin':
+        return os.path.expanduser('~/Library/Caches/Cite')
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    return os.path.join(base, 'cite')
+
+
+path = os.path.join(_runtimeDirectory(), 'cite.sock')
+WORKERS = 8  # lookups served at once
+
+
+def connect():
+    """ Return socket connected to the daemon, or None if it is not running. """
+    if not os.path.exists(path):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except socket.error:
+        sock.close()
+        return None
+    return sock
+
+
+def _hasQuery(args):
+    """ True if arguments contain a query, not just options. """
+    if args and args[0][:1] == '-':
+        args = args[1:]
+    return any(c.isalnum() or c == '_' for c in ' '.join(args))
+
+
+def _text(string):
+    """ Pass bytes of any encoding through JSON, see _bytes. """
+    if string is None:
+        return None
+    return string.decode('latin-1')
+
+
+def _bytes(text):
+    """ Recover bytes passed by _text. """
+    if text is None:
+        return None
+    return text.encode('latin-1')
+
+
+def request(args):
+    """
+    Let the daemon do the lookup and print its output.
+
+    Returns False if the daemon is not running or the query must be typed
+    in, and nothing was read from standard input.
+    """
+    stdin = None
+    fromStdin = not _hasQuery(args)
+    if fromStdin and sys.stdin.isatty():
+        # query is typed in
+        return False
+    sock = connect()
+    if sock is None:
+        return False
+    answer = []
+    try:
+        if fromStdin:
+            stdin = sys.stdin.read()
+        sock.sendall(json.dumps({'args': map(_text, args),
+                                 'stdin': _text(stdin)}))
+        sock.shutdown(socket.SHUT_WR)
+        while True:
+            data = sock.recv(65536)
+            if not data:
+                break
+            answer.append(data)
+    except socket.error:
+        answer = []
+    finally:
+        sock.close()
+    answer = ''.join(answer)
+    if not answer:
+        # daemon failed, do the lookup here
+        from citeTerminal import startTerminal
+        startTerminal(args, stdin)
+    elif answer[0] == '1':
+        print answer[1:]
+    return True
+
+
+def serve():
+    """ Serve lookups until interrupted. """
+    import SocketServer
+    import signal
+    import threading
+    from collections import defaultdict
+    from multiprocessing.pool import ThreadPool
+    import citeTerminal
+
+    class Handler(SocketServer.StreamRequestHandler):
+
+        """ Single lookup. """
+
+        def handle(self):
+            message = self.rfile.read()
+            if not message:
+                # connect() checking that the daemon is running
+                return
+            message = json.loads(message)
+            args = map(_bytes, message['args'])
+            stdin = _bytes(message['stdin'])
+            # options of one lookup do not affect others
+            dct = defaultdict(str, self.server.settings())
+            query = citeTerminal.getQuery(args, stdin)
+            query = citeTerminal.optionsFromQuery(query, dct)
+            results = citeTerminal.lookup(query, dct)
+            if results is None:
+                self.wfile.write('0')
+                return
+            if isinstance(results, unicode):
+                results = results.encode('utf-8')
+            self.wfile.write('1' + results)
+
+    class Server(SocketServer.UnixStreamServer):
+
+        """ Server handing connections to a pool of worker threads. """
+
+        def __init__(self):
+            """ Bind the socket and read settings. """
+            SocketServer.UnixStreamServer.__init__(self, path, Handler)
+            self.pool = ThreadPool(WORKERS)
+            self.lock = threading.Lock()
+            self.mtime = None
+            self.current = None
+
+        def settings(self):
+            """ Return settings, read again if settings.xml changed. """
+            try:
+                mtime = os.path.getmtime(citeTerminal.path + '/settings.xml')
+            except OSError:
+                mtime = None
+            with self.lock:
+                if self.current is None or mtime != self.mtime:
+                    self.current = citeTerminal.readSettings()
+                    self.mtime = mtime
+                return self.current
+
+        def process_request(self, request, client_address):
+            self.pool.apply_async(self._work, (request, client_address))
+
+        def _work(self, request, client_address):
+            """ Serve a connection in a worker thread. """
+            try:
+                self.finish_request(request, client_address)
+            except:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    if os.path.exists(path):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(path)
+        except socket.error as e:
+            if e.errno != errno.ECONNREFUSED:
+                print "Cannot use {0}: {1}".format(path, e)
+                return 1
+            # left behind by a daemon that was killed
+            os.remove(path)
+        else:
+            print "Daemon is already running."
+            return 1
+        finally:
+            sock.close()
+    elif not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path), 0700)
+    # only the current user can send lookups
+    umask = os.umask(077)
+    try:
+        server = Server()
+    finally:
+        os.umask(umask)
+
+    def stop(signum, frame):
+        raise SystemExit(0)
+    signal.signal(signal.SIGTERM, stop)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(path)
+    return 0
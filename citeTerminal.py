@@ -20,15 +20,17 @@ See optionsFromQuery for available options.
 import re
 import os
 
-# fetchers
-from arxiv import ArXiv
-from msn import MathSciNet
-from zbl import Zbl
-from batch import Batch
 from fetch import fixQuery
+import cache
 
 
 settings = None
+path = os.path.dirname(os.path.realpath(__file__))
+# fetchers as (module, class), only the chosen one is imported
+fetchers = {'batch': ('batch', 'Batch'),
+            'msn': ('msn', 'MathSciNet'),
+            'zbl': ('zbl', 'Zbl'),
+            'arxiv': ('arxiv', 'ArXiv')}
 convert = {'int': lambda x: int(x),
            'float': lambda x: float(x),
            'str': lambda x: str(x),
@@ -39,10 +41,14 @@ convert = {'int': lambda x: int(x),
 def getSettings():
     """ Read settings from xml file. """
     global settings
+    settings = readSettings()
+
+
+def readSettings():
+    """ Return settings read from xml file. """
     from collections import defaultdict
     settings = defaultdict(str)
     try:
-        path = os.path.dirname(os.path.realpath(__file__))
         with open(path + '/settings.xml') as f:
             xml = f.read()
         import xml.etree.cElementTree as et
@@ -56,18 +62,25 @@ def getSettings():
                 pass
     except:
         print "No settings file. Continuing with a minimal configuration. "
-    settings['fetcher'] = Batch
+    cache.configure(settings)
+    settings['fetcher'] = 'batch'
     # use batch formatting
     settings["type"] = 'batch'
     settings["html"] = False
     settings["count"] = 0
+    return settings
+
 
+def getQuery(args=None, stdin=None):
+    """
+    Read user's query string from wherever you can.
 
-def getQuery():
-    """ Read user's query string from wherever you can. """
+    args and stdin replace command line arguments and standard input.
+    """
     import sys
     options = ""
-    args = sys.argv[1:]
+    if args is None:
+        args = sys.argv[1:]
     if args and args[0][0] == '-':
         options = re.sub(r'\W', '', args[0])
         args = args[1:]
@@ -76,9 +89,11 @@ def getQuery():
     query = ' '.join(args)
     if args and re.sub(r"\W", "", query):
         return options + query
-    if not sys.stdin.isatty():
+    if stdin is None and not sys.stdin.isatty():
+        stdin = sys.stdin.read()
+    if stdin is not None:
         # query from stdin
-        query = options + sys.stdin.read()
+        query = options + stdin
         query = fixQuery(query)
         return query
     else:
@@ -86,8 +101,10 @@ def getQuery():
         return options + raw_input("Search query: ")
 
 
-def optionsFromQuery(query):
-    """ Extract (?...) options from query. """
+def optionsFromQuery(query, dct=None):
+    """ Extract (?...) options from query into dct (settings by default). """
+    if dct is None:
+        dct = settings
     m = re.match("(?si)((?:\(\?[^)]*\)|\s)+)?(.*)", query)
     query = m.group(2)
     try:
@@ -98,60 +115,84 @@ def optionsFromQuery(query):
         return query
     if 'b' in options:
         # force bibtex output
-        settings["bibtexOut"] = True
+        dct["bibtexOut"] = True
     elif 'f' in options or 'l' in options:
         # force formatted output
-        settings["bibtexOut"] = False
+        dct["bibtexOut"] = False
     if 's' in options:
         # use search mode formatting
-        settings["type"] = 'search'
+        dct["type"] = 'search'
     elif 'B' in options:
         # use batch mode formatting
-        settings["type"] = 'batch'
+        dct["type"] = 'batch'
     if 'm' in options:
         # force MSN
-        settings["fetcher"] = MathSciNet
+        dct["fetcher"] = 'msn'
     elif 'z' in options:
         # force zbMATH
-        settings["fetcher"] = Zbl
+        dct["fetcher"] = 'zbl'
     elif 'a' in options:
         # force arXiv
-        settings["fetcher"] = ArXiv
-    m = re.search(r'(\d+)', options)
+        dct["fetcher"] = 'arxiv'
+    m = re.search(r'(?:^|[^t\d])(\d+)', options)
     if m and m.group(1):
         # find this many references
-        settings["count"] = int(m.group(1))
+        dct["count"] = int(m.group(1))
+    m = re.search(r't(\d+)', options)
+    if m:
+        # give up after this many seconds
+        dct["timeout"] = int(m.group(1))
+    if 'v' in options:
+        # report downloaded bytes
+        dct["verbose"] = True
     return query
 
 
-def startTerminal():
+def startTerminal(args=None, stdin=None):
     """ Start searching. """
     # get settings
     getSettings()
-    query = getQuery()
+    query = getQuery(args, stdin)
     query = optionsFromQuery(query)
+    results = lookup(query, settings)
+    if results is not None:
+        print results
+    return 0
+
+
+def lookup(query, dct):
+    """
+    Run the fetcher chosen in dct on query without options.
+
+    Returns the text to print, or None if the query is empty.
+    """
     if not re.sub(r"\W", "", query):
-        return 0
+        return None
 
     # extract separate queries
-    count = settings["count"]  # count from options
+    count = dct["count"]  # count from options
     if count <= 0:
         # count from settings file
-        count = settings[settings["type"] + "Count"]
+        count = dct[dct["type"] + "Count"]
     # make sure count makes sense
     try:
         count = int(count)
         assert count > 0
     except:
         count = 3
+    if dct["verbose"]:
+        import network
+        before = dict(network.stats)
     # run the chosen fetcher
-    fetcher = settings['fetcher']()
-    results = fetcher(query, count, settings)[1]
-    if fetcher.number > 0:
-        print results
-    else:
-        print query
-    return 0
+    module, name = fetchers[dct['fetcher']]
+    fetcher = getattr(__import__(module), name)()
+    results = fetcher(query, count, dct)[1]
+    if fetcher.number <= 0:
+        results = query
+    if dct["verbose"]:
+        # comment line in both BibTeX and LaTeX
+        results += "\n% " + network.statsText(before)
+    return results
 
 
 if __name__ == "__main__":
@@ -38,11 +38,12 @@ except:
 
 # fetchers
 from arxiv import ArXiv
-from fetch import Fetch, fixQuery
-from batch import batchSplit, Batch
+from fetch import Fetch, fixQuery, formatRefs
+from batch import batchSplit, Batch, THREADS
 from msn import MathSciNet, MRef
 from zbl import Zbl
 from progress2 import Progress
+import cache
 
 
 class Cite(Ui_Cite, QMainWindow):
@@ -287,6 +288,9 @@ class Cite(Ui_Cite, QMainWindow):
                     self.text += '\n<h2>{}: {} result{}.</h2>\n' \
                         .format(record['name'], record['number'],
                                 's' if record['number'] > 1 else '') + txt
+                elif record['skipped']:
+                    self.text += '\n<h2>{} skipped, server is not ' \
+                        'responding.</h2>'.format(record['name'])
                 else:
                     self.text += '\n<h2>{} failed!</h2>' \
                         .format(record['name'])
@@ -387,6 +391,8 @@ class Cite(Ui_Cite, QMainWindow):
         dct = settings.as_dict()
         dct['html'] = True
         dct['type'] = 'batch'
+        # all references are formatted at once after the searches
+        dct['formatLater'] = True
         count = settings.get('batchCount')
         queries, dct = batchSplit(query, dct)
         fetcherdict = {'arXiv': ArXiv, 'MathSciNet': MathSciNet,
@@ -400,12 +406,23 @@ class Cite(Ui_Cite, QMainWindow):
             fetchers.append(fetcher())
             # make a copy of dct for threading safety
             args.append((query, count, dict(dct)))
-        progress = Progress(fetchers, args, job="Searching ...")
+        progress = Progress(fetchers, args, job="Searching ...",
+                            threads=THREADS)
         progress.exec_()
+        found = [r for r in progress.res if r['number']]
+        # Batch keeps the fetcher whose records it returned
+        used = [fetchers[r['index']] for r in found]
+        used = [getattr(f, 'result', f) for f in used]
+        for record, text in zip(found, formatRefs(used, dct)):
+            record['result'] = (record['result'][0], text)
         result = ""
         self.batchLastBibtex = settings.get('bibtexOut')
         for record in progress.res:
-            if record['number'] == 0:
+            if record['number'] == 0 and record['failed']:
+                color = 'red'
+                s = '% Search failed, server not reachable, for\n\n{}' \
+                    .format(record['query'])
+            elif record['number'] == 0:
                 color = 'red'
                 s = '% No match found for\n\n{}' \
                     .format(record['query'])
@@ -420,6 +437,8 @@ class Cite(Ui_Cite, QMainWindow):
                 color = 'black'
                 s = record['result'][1]
                 self.batchBibtext += record['result'][0]
+            if record['partial']:
+                s = '% Search timed out, results may be incomplete\n\n' + s
             result += '<font color="{}"><p>{}</p></font>' \
                 .format(color, self.HTMLsafe(s, settings.get('bibtexOut')))
         self.batchEdit.setText(result)
@@ -495,6 +514,7 @@ def startApp():
             settings.set_defaults(settings.config)
     except:
         pass
+    cache.configure(settings.as_dict())
     import sys
     app = QApplication(sys.argv)
     window = Cite()
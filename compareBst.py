@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+"""
+Compare the built-in style interpreter with bibtex.
+
+Usage: compareBst.py [file.bib ...]
+
+Every .bib file (samples.bib by default, records as the MathSciNet,
+zbMATH and arXiv fetchers produce them) is formatted by bibtex and by bst.run with the styles
+produced by BibTex for all sorting, bibitem and font options, and the
+.bbl texts are compared. Differences are printed as unified diffs, with
+times per entry of both. Needs bibtex on the PATH, but not LaTeX.
+"""
+
+import difflib
+from distutils.spawn import find_executable
+import os
+import sys
+import time
+
+import bst
+from bibtex import BibTex, runBibtex
+
+_PATH = os.path.dirname(os.path.realpath(__file__))
+_FONTS = {'titleStyle': 'emph', 'journalStyle': 'textit',
+          'volumeStyle': 'textbf', 'authorStyle': 'textsc'}
+
+
+def options():
+    """ Yield format dictionaries covering the options of the template. """
+    for sortBy in ('name', 'newest first', 'oldest first'):
+        for bibitem in ('', '{initialsyear}', '[initialsyear]', '{id}'):
+            for fonts in ({}, _FONTS):
+                dct = {'sortBy': sortBy, 'genBibitems': bool(bibitem),
+                       'bibitemStyle': bibitem}
+                dct.update(fonts)
+                yield dct
+    yield {'query': True}
+
+
+def compare(name):
+    """ Compare outputs for one .bib file, return number of differences. """
+    with open(name) as f:
+        bib = f.read()
+    differences = 0
+    for dct in options():
+        style = BibTex(**dct).bst
+        start = time.time()
+        expected = runBibtex(style, bib)
+        external = time.time() - start
+        # styles are parsed once per process, see bst.Style.get
+        machine = bst.Machine(bst.Style.get(style))
+        start = time.time()
+        output = machine.run(bib)
+        internal = time.time() - start
+        entries = max(len(machine.entries), 1)
+        print '{0} {1}: bibtex {2:.3f} ms, bst {3:.3f} ms per entry'.format(
+            name, sorted(dct.items()), 1000 * external / entries,
+            1000 * internal / entries)
+        if output != expected:
+            differences += 1
+            sys.stdout.writelines(difflib.unified_diff(
+                expected.splitlines(True), output.splitlines(True),
+                'bibtex', 'bst'))
+    return differences
+
+
+def main():
+    if sys.argv[1:2] in (['-h'], ['--help']):
+        print __doc__.strip()
+        return 2
+    if not find_executable('bibtex'):
+        print 'bibtex is not installed'
+        return 2
+    names = sys.argv[1:] or [os.path.join(_PATH, 'samples.bib')]
+    differences = sum(compare(name) for name in names)
+    print differences, 'differences'
+    return 1 if differences else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
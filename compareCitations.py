@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+"""
+Compare citation query normalization with its original implementation.
+
+Usage: compareCitations.py [-n random] [file ...]
+
+Citations are read from the files (citations.txt by default), separated
+by empty lines. Each of them, and the given number of random citations
+mixed from their pieces and special characters, goes through
+Fetch._citationQuery and through the original chain of re.sub calls it
+replaced, as str and as unicode. Differences are printed.
+"""
+
+import os
+import random
+import re
+import sys
+
+from fetch import Fetch
+
+_PATH = os.path.dirname(os.path.realpath(__file__))
+_SPECIAL = list("][{}?%#():`&=/,'-.\\~$*") + \
+    ['\\bibitem{X} ', '\\emph{', '\\c s', "{\\'{\\i}}", '{\\l}', '\n',
+     ' and ', ' the ', ' 12--34 ', ' 2001 ', ' 123456 ', ' MR 1234567 ',
+     ' Zbl 0123 ', ' arXiv:1234 ', ' http://x.org ', ' (electronic) ',
+     ' to appear ', ' Springer ', ' Vol. ', ' ab. ']
+
+
+def original(query):
+    """ Fetch._citationQuery before the patterns were precompiled. """
+    bibitem = ""
+    match = re.match(
+        r"\s*(\\bibitem\s*(\[.*?\])?\s*\{(\w|\{(\{.*?\}|[^{}])*?\}|\+)*\})",
+        query)
+    if match:
+        bibitem = match.group(1)
+    query = re.sub(
+        r"\s*(\\bibitem\s*(\[.*?\])?\s*\{(\w|\{(\{.*?\}|[^{}])*?\}|\+)*\})",
+        "", query)
+    query = re.sub(r"(?si)mr\d{6,}", "", query)
+    query = re.sub(r"(?si)(https?:|\\doi|\\mref|\\arxiv|MR\s*:?\s*\d{4,}|" +
+                   r"zbl\s*\d+|arxiv:?\s*\d+|\\url|\\href).*", "", query)
+    query = re.sub(r"(?si)\\[A-Za-z]{2,}", "", query)
+    query = re.sub(r"(?si)\{\\'\{\\i\}\}|\\'\\i\s", "i", query)
+    query = re.sub(r"(?si)\\c s", "s", query)
+    query = re.sub(r"(?si)\{\\l\}", "l", query)
+    query = re.sub(r"(?si)\\\W\s?|\\\w(?=\\|\{)", "",
+                   query).replace('~', ' ')
+    query = re.sub(r"(?si)\$.*?\$", "", query)
+    query = re.sub(r"(?si)\(electronic\)", " ", query)
+    query = re.sub(r"(?si)(dedicated\s+to).*", " ", query)
+    query = re.sub(r"[][{}?%#():`]", "", query)
+    query = re.sub(r"[&=/,']", " ", query)
+    query = re.sub(r"(?si)\b(and|not|und|art|vol|eds|isbn|inc|the|with)\b",
+                   " ", query)
+    query = re.sub(r"(?si)\b[A-Za-z]{1,2}\b", " ", query)
+    query = re.sub(r"(?si)\b\d+\s*-+\s*\d+\b", " ", query)
+    query = re.sub(r"(?si)\b(\d{1,3}|\d{5,})\b", " ", query)
+    query = re.sub(r"(?si)\b(preparation|arxiv|preprint|to\s+appear|" +
+                   r"submitted|translated\s+from).*",
+                   " ", query)
+    query = re.sub(r"Birkhauser|Springer|New York|Paris|Heidelberg|" +
+                   r"Boston|Basel|Grenoble|Verlag",
+                   "", query)
+    query = re.sub(r"(\b[a-zA-Z]{,4})\.", r"\1*", query)
+    query = re.sub(r"[-.]", " ", query)
+    query = re.sub(r"\\", "", query)
+    query = re.sub(r"\s+\*+(\s+|$)", " ", query)
+    query = re.sub(r"(?si)([\s\n\r]+)", " ", query).strip()
+    year = re.findall(r'\d{4}', query)
+    if year and len(year) == 1:
+        query = re.sub(r'\d{4}', ' ', query)
+        return bibitem, [('none', query), ('date', year[0])]
+    else:
+        return bibitem, [('none', query)]
+
+
+def current(query):
+    """ Output of Fetch._citationQuery, with the saved bibitem. """
+    fetcher = Fetch()
+    fetcher.bibitem = ""
+    fields = fetcher._citationQuery(query)
+    return fetcher.bibitem, fields
+
+
+def mixed(citations, count, seed=0):
+    """ Yield random citations made of pieces of citations. """
+    rnd = random.Random(seed)
+    words = ' '.join(citations).split(' ')
+    for _ in range(count):
+        pieces = [rnd.choice(_SPECIAL if rnd.random() < 0.3 else words)
+                  for _ in range(rnd.randint(1, 40))]
+        yield ''.join(p + rnd.choice(['', ' ', ' ', '  ']) for p in pieces)
+
+
+def main():
+    args = sys.argv[1:]
+    count = 2000
+    if args[:1] == ['-n']:
+        count = int(args[1])
+        args = args[2:]
+    citations = []
+    for name in args or [os.path.join(_PATH, 'citations.txt')]:
+        with open(name) as f:
+            citations += [c.strip() for c in re.split(r'\n\s*\n', f.read())
+                          if c.strip()]
+    queries = citations + list(mixed(citations, count))
+    differences = 0
+    for query in queries:
+        for q in (query, query.decode('utf-8', 'ignore')):
+            expected, output = original(q), current(q)
+            if output != expected:
+                differences += 1
+                print repr(q)
+                print '  original:', repr(expected)
+                print '  current: ', repr(output)
+    print len(queries), 'citations,', differences, 'differences'
+    return 1 if differences else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
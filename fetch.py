@@ -1,11 +1,251 @@
 """ Abstract class for fetching the results from web engines. """
 
+import functools
+import hashlib
 import urllib
-import urllib2
 import re
+import json
+import socket
+import threading
+import time
 import unicodedata
-from bibtex import BibTex
-from collections import defaultdict
+import bibfile
+import cache
+from collections import OrderedDict, defaultdict, namedtuple
+from HTMLParser import HTMLParser
+
+# entities decoded in extracted text, others are left for BibTeX
+_ENTITIES = {'lt': '<', 'gt': '>', 'amp': '&'}
+
+
+_BIBITEM = re.compile(
+    r"\s*(\\bibitem\s*(\[.*?\])?\s*\{(\w|\{(\{.*?\}|[^{}])*?\}|\+)*\})")
+_YEAR = re.compile(r'\d{4}')
+# removed characters which are replaced by a space, others are dropped
+_SPACED = frozenset("&=/,'-.")
+
+
+def _dropOrSpace(match):
+    """ Replacement for characters removed from citation queries. """
+    return " " if match.group(0) in _SPACED else ""
+
+
+# cleanup of full citations, applied in order by Fetch._citationQuery
+# passes which cannot interact are merged into a single pattern
+_CITATION_CLEANUP = [(re.compile(p), r) for p, r in [
+    # remove links and numbers from the end
+    (r"(?si)mr\d{6,}", ""),
+    (r"(?si)(https?:|\\doi|\\mref|\\arxiv|MR\s*:?\s*\d{4,}|"
+     r"zbl\s*\d+|arxiv:?\s*\d+|\\url|\\href).*", ""),
+    # remove tex commands
+    (r"(?si)\\[A-Za-z]{2,}", ""),
+    # remove accents, but not {letter}
+    (r"(?si)\{\\'\{\\i\}\}|\\'\\i\s", "i"),
+    (r"(?si)\\c s", "s"),
+    (r"(?si)\{\\l\}", "l"),
+    (r"(?si)\\\W\s?|\\\w(?=\\|\{)", ""),
+    (r"~", " "),
+    # remove formulas
+    (r"(?si)\$.*?\$", ""),
+    # remove a few words
+    (r"(?si)\(electronic\)", " "),
+    (r"(?si)(dedicated\s+to).*", " "),
+    # remove certain characters
+    (r"[][{}?%#():`&=/,']", _dropOrSpace),
+    # remove short words
+    (r"(?si)\b(and|not|und|art|vol|eds|isbn|inc|the|with|[A-Za-z]{1,2})\b",
+     " "),
+    # remove all numbers except for years (4 digits)
+    (r"(?si)\b(\d+\s*-+\s*\d+|\d{1,3}|\d{5,})\b", " "),
+    # remove preprint and other endings
+    (r"(?si)\b(preparation|arxiv|preprint|to\s+appear|"
+     r"submitted|translated\s+from).*", " "),
+    # remove publisher names, places and some other words
+    (r"Birkhauser|Springer|New York|Paris|Heidelberg|"
+     r"Boston|Basel|Grenoble|Verlag", ""),
+    # short word with . is most likely an abbreviation
+    (r"(\b[a-zA-Z]{,4})\.", r"\1*"),
+    # remove a few more characters
+    (r"[-.\\]", _dropOrSpace),
+    (r"\s+\*+(\s+|$)", " "),
+    # remove extra white characters
+    (r"(?si)([\s\n\r]+)", " ")]]
+
+
+# cleanup of field queries, applied in order by Fetch._fieldsQuery
+_FIELDS_CLEANUP = [(re.compile(p), r) for p, r in [
+    # remove tex commands
+    (r"(?si)\\[A-Za-z]{2,}", ""),
+    # remove accents, but not {?}
+    (r"(?si)\\\W|\\\w(?=\\|\{)", ""),
+    (r"~", " "),
+    # remove formulas
+    (r"(?si)\$.*?\$", ""),
+    # remove {}&?%=/#.
+    (r"[{}&?%=/#.]", "")]]
+# field indicator starts a new line
+_FIELD_START = re.compile(r"(?<=[\s()])([a-zA-Z]{2,3}|date|year|type):")
+# query is a sequence of newlines, blanks, parentheses, words and the rest
+_TOKEN = re.compile(r"\n|[^\S\n]+|[()]|\w+|[^\w\s()]+")
+_CONNECTORS = frozenset(['and', 'or', 'not'])
+_DATE = re.compile(r"(?si)((?:py|yr|dt|date|year):[\D]*?)?"   # field or not
+                   r"([<=>]?\s*\d{4}(\s*-+\s*\d{4}|(\b\d{4}\b|[,\s])+)?)")
+_TYPE = re.compile(r"type:|ty:|\s*(not\s)?\s*(book|journal|proceeding)")
+_AUTHOR = re.compile(r"(?si)(a|au|aut[hors]*):(?P<c>.*)")
+_INITIAL = re.compile(r"(\w{2,},\s+\w)(?=\s|$)")
+_JOURNAL = re.compile(r"(?si)(j|jo|jou[rnal]*|s|so|sou[rce]|jr*):(?P<c>.*)")
+_TITLE = re.compile(r"(?si)(t|ti|tit[le]*):(?P<c>.*)")
+_ALL = re.compile(r"(any|all|^):")
+_OTHER = re.compile(r"(?si)(\w{2,3}):\s*(.*)$")
+_NAME = re.compile(r"(?si)\s*\w+,\s+\w(\s|\*|$)")
+
+
+def _isLogic(token):
+    """ Check if token is a blank, parenthesis or logical connector. """
+    return token.isspace() or token in '()' or token.lower() in _CONNECTORS
+
+
+class Field(namedtuple('Field', 'key value')):
+
+    """ Search field with its value. """
+
+    __slots__ = ()
+
+
+class Logic(str):
+
+    """ Parentheses and logical connectors between fields. """
+
+    __slots__ = ()
+
+    @property
+    def connector(self):
+        """ Last connector in upper case, AND if there is none. """
+        words = [t for t in _TOKEN.findall(self) if t.lower() in _CONNECTORS]
+        return words[-1].upper() if words else 'AND'
+
+
+# parsed field queries shared by all fetchers
+_parsedFields = cache.LRUCache(256)
+# records parsed by setBibtex
+_parsedBibtex = cache.LRUCache(32)
+# formatted references, keyed by formatKey, also kept in cache.formatted
+_formatted = cache.LRUCache(512)
+_FORMAT_TTL = 30 * 24 * 3600  # seconds to keep formatted references on disk
+
+
+class Cancelled(Exception):
+
+    """ Search was cancelled before the request was sent. """
+
+
+class DeadlineExceeded(Cancelled):
+
+    """ No time left for the request. """
+
+
+class CircuitBreaker(object):
+
+    """
+    Stop using a source after repeated failures.
+
+    After self.threshold failed searches in a row the breaker opens and
+    searches are skipped. After self.cooldown seconds a single search is
+    let through to probe the source (half-open state). Success closes the
+    breaker, failure opens it again.
+    """
+
+    def __init__(self, threshold=5, cooldown=60):
+        """ Start closed. """
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.openedAt = None
+        self.probing = False
+        self.lock = threading.Lock()
+
+    def state(self):
+        """ Return 'closed', 'open' or 'half-open'. """
+        with self.lock:
+            if self.openedAt is None:
+                return 'closed'
+            if self.probing or time.time() - self.openedAt >= self.cooldown:
+                return 'half-open'
+            return 'open'
+
+    def allow(self):
+        """ Decide if a search can be executed now. """
+        with self.lock:
+            if self.openedAt is None:
+                return True
+            if self.probing or time.time() - self.openedAt < self.cooldown:
+                return False
+            self.probing = True
+            return True
+
+    def record(self, success):
+        """ Update state with the outcome of a search. """
+        with self.lock:
+            self.probing = False
+            if success:
+                self.failures = 0
+                self.openedAt = None
+                return
+            self.failures += 1
+            if self.failures >= self.threshold or self.openedAt is not None:
+                self.openedAt = time.time()
+
+    def release(self):
+        """ Search was cancelled, so its outcome says nothing. """
+        with self.lock:
+            self.probing = False
+
+
+_breakers = {}
+_breakersLock = threading.Lock()
+
+
+def breakerFor(name):
+    """ Return circuit breaker for a source. """
+    with _breakersLock:
+        if name not in _breakers:
+            _breakers[name] = CircuitBreaker()
+        return _breakers[name]
+
+
+class PageParser(HTMLParser):
+
+    """
+    Base class for single pass extraction of records from result pages.
+
+    The page can be fed in chunks, as it arrives from the server.
+    Subclasses put finished records in self.records. Once limit records
+    are found, the rest of the page is ignored and need not be downloaded.
+    """
+
+    def __init__(self, limit=None):
+        """ Start with no records. """
+        HTMLParser.__init__(self)
+        self.records = []
+        self.limit = limit
+
+    @property
+    def full(self):
+        """ True if enough records were found. """
+        return self.limit is not None and len(self.records) >= self.limit
+
+    def feed(self, data):
+        """ Parse data, unless enough records were found already. """
+        if not self.full:
+            HTMLParser.feed(self, data)
+
+    def handle_entityref(self, name):
+        """ Decode &lt; &gt; &amp; and keep other entities. """
+        self.handle_data(_ENTITIES.get(name, '&' + name + ';'))
+
+    def handle_charref(self, name):
+        """ Keep character references. """
+        self.handle_data('&#' + name + ';')
 
 
 class Fetch(object):
@@ -14,15 +254,32 @@ class Fetch(object):
     Abstract class handling GET/POST requests.
 
     class variable url: holds main part of the link to web engine
-    self.refs: holds bibtex string
+    class variable size: parameter setting the number of results on a page,
+        pages are then no longer than the number of requested results
+    class variable parser: PageParser subclass for result pages, pages are
+        then parsed while they are downloaded
+    self.records: list of bibfile.Record
+    self.refs: bibtex string of the records, assigning a bibtex string
+        parses and cleans it up
     self.nonunique: true if exactly one result found
     self.number: number of results
+    self.partial: true if the search ran out of time
+    self.failed: true if a server could not be reached, so that no results
+        does not necessarily mean no match
+    self.skipped: true if search was not executed, since the source failed
+        repeatedly (see CircuitBreaker)
     """
 
     url = ""
     correction = 0
     onceMax = 100
     more = ""
+    size = ""
+    cacheTTL = 30 * 24 * 3600  # seconds to keep downloaded records
+    # seconds to keep search pages and results, new records appear daily
+    searchTTL = 24 * 3600
+    parser = None
+    generic = True  # search uses generic fields of the prepared query
 
     def __init__(self, otherID=False):
         """
@@ -33,11 +290,33 @@ class Fetch(object):
         Even if user requests 1 record, it may still be nonunique, since
         fetcher might find more than 1 and return just 1.
         """
-        self.refs = []
+        self.records = []
         self.nonunique = True
         self.bibitem = ""
         self.number = 0
         self.otherID = otherID
+        # set to stop sending requests
+        self.cancel = threading.Event()
+        # time after which no requests are sent
+        self.deadline = None
+        self.partial = False
+        self.failed = False
+        self.skipped = False
+
+    @property
+    def refs(self):
+        """ BibTex string of the records. """
+        return bibfile.write(self.records, indent='    ')
+
+    @refs.setter
+    def refs(self, bibstr):
+        """ Parse bibtex string into records, ensuring uniform look. """
+        self.records = bibfile.records(bibstr, homogeneize_latex_encoding)
+
+    @property
+    def breaker(self):
+        """ Circuit breaker shared by all fetchers of this class. """
+        return breakerFor(self.__class__.__name__)
 
     def __call__(self, query, count, dct):
         """
@@ -47,71 +326,265 @@ class Fetch(object):
 
         Returns BibTex and LaTex outputs.
         """
+        self.setTimeout(dct.get("timeout"))
         if "website" in dct and dct["website"]:
             return '', self.getWebsite(query, count)
         else:
             self.fetch(query, count)
             return self.refs, self.getRefs(**dct)
 
+    def setTimeout(self, timeout):
+        """ Allow the search to take timeout seconds from now. """
+        try:
+            timeout = float(timeout)
+        except (TypeError, ValueError):
+            return
+        if timeout > 0:
+            self.deadline = time.time() + timeout
+
     def fetch(self, query, count=100):
         """ Process the query and execute search. """
         self.count = count
-        query = fixQuery(query)
+        self.partial = False
+        self.failed = False
+        self.skipped = False
+        query = prepareQuery(query, [self])
         query_dict = self._preprocessQuery(query)
         if not query_dict:
             self.number = 0
-            self.refs = ""
+            self.records = []
             self.nonunique = True
             return False
-        query = self._formatQuery(query_dict)
-        query = urllib.urlencode(query) + "&"
-        self.query = query
-        found = 0
-        allrefs = []
-        while found < count:
-            full_url = self.url + query
-            if self.more:
-                full_url += self.more + str(found+self.correction)
-            try:
-                data = urllib2.urlopen(full_url).read()
-                self._processResults(data)
-                self._cleanupBibTex(count)
-            except:
-                self.number = 0
-            if self.number == 0:
-                break
-            allrefs.append(self.refs)
-            found += self.number
-            if not self.more or found < self.onceMax:
-                break
-        self.refs = '\n\n'.join(allrefs)
+        key = self._cacheKey(query_dict, count)
+        cached = cache.results.get(key)
+        if cached is not None:
+            cached = json.loads(cached)
+        if cached is not None and 'records' in cached:
+            self.records = [bibfile.Record.fromJSON(r)
+                            for r in cached['records']]
+            self.number, self.nonunique = \
+                cached['number'], cached['nonunique']
+            return True
+        if not self.breaker.allow():
+            # source is down, do not wait for it
+            self.skipped = self.failed = True
+            self.number = 0
+            self.records = []
+            self.nonunique = True
+            return False
+        try:
+            query = self._formatQuery(query_dict)
+            query = urllib.urlencode(query) + "&"
+            self.query = query
+            allrecords = []
+            import network
+            first = self._fetchPage(0)
+            found = self._processPage(first, count, allrecords)
+            if found == 0 and first is not None:
+                # do not keep answering with an empty page
+                network.forget(self._pageUrl(0))
+            if self.more and self.onceMax <= found < count:
+                # first page was full, get the remaining pages concurrently
+                total = min(count, self._totalResults(first) or count)
+                offsets = range(found, total, self.onceMax)
+                pages = network.parallelMap(self._fetchPage, offsets)
+                # pages come back in offset order
+                for offset, data in zip(offsets, pages):
+                    number = self._processPage(data, count, allrecords)
+                    if number == 0:
+                        if data is not None:
+                            network.forget(self._pageUrl(offset))
+                        break
+                    found += number
+            if self.deadline is not None and time.time() > self.deadline:
+                self.partial = True
+        except:
+            # an unexpected error must not leave the probe of a half-open
+            # breaker running forever
+            if self.cancel.is_set():
+                self.breaker.release()
+            else:
+                self.breaker.record(False)
+            raise
+        if self.cancel.is_set() or \
+                (found == 0 and self.partial and not self.failed):
+            # cancelled or out of time, the source may still be fine
+            self.breaker.release()
+        else:
+            self.breaker.record(found > 0 or not self.failed)
         # result can be nonunique even if user wants to see 1 record
         self.nonunique = found > 1
-        if found > count:
-            # too many results, truncate
-            self.refs = '\n\n'.join(self.refs.split('\n\n')[:count])
-            found = count
-        self.number = found
+        # too many results, truncate
+        self.records = allrecords[:count]
+        self.number = len(self.records)
         if self.number == 0:
-            self.refs = ""
             self.nonunique = True
             return False
+        if self.cancel.is_set() or self.partial or self.failed:
+            # some pages may be missing
+            return True
+        cache.results.put(key, json.dumps({
+            'records': [r.toJSON() for r in self.records],
+            'number': self.number,
+            'nonunique': self.nonunique}), self.searchTTL)
         return True
 
+    def _cacheKey(self, query_dict, count):
+        """
+        Key identifying results of a preprocessed query.
+
+        Whitespace is normalized, and the order of fields does not matter
+        when they are all joined by the implicit 'and'.
+        """
+        fields = []
+        logic = False
+        for e in query_dict:
+            if isinstance(e, tuple):
+                fields.append(tuple(' '.join(v.split()) for v in e))
+            elif e.strip():
+                logic = True
+                fields.append(' '.join(e.split()))
+        if not logic:
+            fields.sort()
+        return repr((self.__class__.__name__, fields, count,
+                     bool(self.otherID)))
+
+    def _pageUrl(self, offset):
+        """ Address of the page of results starting at offset. """
+        # records past count are thrown away, but one more record shows
+        # that the result is not unique
+        limit = self.count + 1 - offset
+        full_url = self.url + self.query
+        if self.size:
+            full_url += self.size + str(min(limit, self.onceMax)) + "&"
+        if self.more:
+            full_url += self.more + str(offset + self.correction)
+        return full_url
+
+    def _fetchPage(self, offset):
+        """ Download a page of results starting at offset. """
+        import network
+        parser = self.parser
+        if parser is not None:
+            parser = functools.partial(parser,
+                                       limit=self.count + 1 - offset)
+        try:
+            return self._request(self._pageUrl(offset), parser)
+        except (DeadlineExceeded,) + network.errors as e:
+            self._missed(e)
+        except:
+            pass
+        return None
+
+    def _processPage(self, data, count, allrecords):
+        """ Extract records from a page and return their number. """
+        if data is None:
+            return 0
+        import network
+        try:
+            self.records = []
+            self._processResults(data)
+            self.number = len(self.records)
+        except (DeadlineExceeded,) + network.errors as e:
+            # records are downloaded separately by some fetchers
+            self._missed(e)
+            return 0
+        except:
+            return 0
+        allrecords.extend(self.records)
+        return self.number
+
+    def _missed(self, error):
+        """
+        Note why a request did not complete.
+
+        Running out of time before the request was sent only makes the
+        result partial. Server timeouts and network errors also mark the
+        search failed, which counts against the source's circuit breaker.
+        """
+        import network
+        if isinstance(error, (DeadlineExceeded, network.OutOfTime)):
+            self.partial = True
+        elif isinstance(error, socket.timeout):
+            # server did not answer in time
+            self.partial = self.failed = True
+        else:
+            self.failed = True
+
+    def _totalResults(self, data):
+        """
+        Total number of matches reported on the first page.
+
+        Can be implemented in subclasses. None means unknown.
+        """
+        return None
+
+    def _parse(self, data):
+        """ Return page parser fed with data, unless data is parsed already. """
+        if isinstance(data, basestring):
+            page = self.parser()
+            page.feed(data)
+            page.close()
+            return page
+        return data
+
     def getWebsite(self, query, count=100):
         """ Execute search but do not postprocess the results. """
-        query = fixQuery(query)
+        query = prepareQuery(query, [self])
         query_dict = self._preprocessQuery(query)
         query = self._formatQuery(query_dict)
         query = urllib.urlencode(query) + "&"
         full_url = self.website + query
-        data = urllib2.urlopen(full_url).read()
+        data = self._request(full_url)
         data = self._cleanWebsite(data)
         self.number = 1
         self.refs = ""
         return data
 
+    def _request(self, url, parser=None, ttl=None):
+        """
+        Download url through the shared connection pool and cache.
+
+        If parser class is given, return parser fed with the page instead.
+        The page is cached for ttl seconds, by default for searchTTL.
+        """
+        import network
+        if self.cancel.is_set():
+            raise Cancelled(url)
+        timeout = None
+        if self.deadline is not None:
+            timeout = self.deadline - time.time()
+            if timeout <= 0:
+                raise DeadlineExceeded(url)
+        if ttl is None:
+            ttl = self.searchTTL
+        if parser is not None:
+            return network.parse(url, parser, ttl=ttl, timeout=timeout)
+        return network.request(url, ttl=ttl, timeout=timeout)
+
     def _preprocessQuery(self, query):
+        """
+        Turn prepared query into a list of fields for _formatQuery.
+
+        Identifiers recognized by the source take precedence over the
+        generic fields shared by all sources.
+        """
+        ids = query.idFields(self)
+        if ids is None:
+            ids = self._idQuery(query.text)
+        if ids:
+            return list(ids)
+        self.bibitem = query.bibitem
+        if query.fields is None:
+            # query was prepared only for sources not using the fields
+            return self._parseQuery(query.text)
+        return list(query.fields)
+
+    def _idQuery(self, query):
+        """ Return fields for identifiers (e.g. MR numbers) in query, if any. """
+        return None
+
+    def _parseQuery(self, query):
         """
         Turn query into a dict with bibtex style fields.
 
@@ -141,14 +614,10 @@ class Fetch(object):
 
     def _bibtexQuery(self, query):
         """ Turn query into bibtex dictionary. """
-        import bibtexparser
-        from bibtexparser.bparser import BibTexParser
-        parser = BibTexParser()
-        parser.customization = homogeneize_latex_encoding
-        bib = bibtexparser.loads(query, parser=parser)
-        if bib.entries:
+        entries = bibfile.loads(query, homogeneize_latex_encoding)
+        if entries:
             # only the first record
-            record = bib.entries[0]
+            record = entries[0]
             # clean up entries
             if "author" in record:
                 # just last name
@@ -171,63 +640,17 @@ class Fetch(object):
     def _citationQuery(self, query):
         """ Save bibitem and strip formatting from query. """
         # get rid of bibitem and save it
-        match = re.match(
-            r"\s*(\\bibitem\s*(\[.*?\])?\s*\{(\w|\{(\{.*?\}|[^{}])*?\}|\+)*\})",
-            query)
+        match = _BIBITEM.match(query)
         if match:
             self.bibitem = match.group(1)
-        query = re.sub(
-            r"\s*(\\bibitem\s*(\[.*?\])?\s*\{(\w|\{(\{.*?\}|[^{}])*?\}|\+)*\})",
-            "", query)
-
-        # cleanup
-        # remove links and numbers from the end
-        query = re.sub(r"(?si)mr\d{6,}", "", query)
-        query = re.sub(r"(?si)(https?:|\\doi|\\mref|\\arxiv|MR\s*:?\s*\d{4,}|" +
-                       r"zbl\s*\d+|arxiv:?\s*\d+|\\url|\\href).*", "", query)
-        # remove tex commands
-        query = re.sub(r"(?si)\\[A-Za-z]{2,}", "", query)
-        # remove accents, but not {letter}
-        query = re.sub(r"(?si)\{\\'\{\\i\}\}|\\'\\i\s", "i", query)
-        query = re.sub(r"(?si)\\c s", "s", query)
-        query = re.sub(r"(?si)\{\\l\}", "l", query)
-        query = re.sub(r"(?si)\\\W\s?|\\\w(?=\\|\{)", "",
-                       query).replace('~', ' ')
-        # remove formulas
-        query = re.sub(r"(?si)\$.*?\$", "", query)
-        # remove a few words
-        query = re.sub(r"(?si)\(electronic\)", " ", query)
-        query = re.sub(r"(?si)(dedicated\s+to).*", " ", query)
-        # remove certain characters
-        query = re.sub(r"[][{}?%#():`]", "", query)
-        query = re.sub(r"[&=/,']", " ", query)
-        # remove short words
-        query = re.sub(r"(?si)\b(and|not|und|art|vol|eds|isbn|inc|the|with)\b",
-                       " ", query)
-        query = re.sub(r"(?si)\b[A-Za-z]{1,2}\b", " ", query)
-        # remove all numbers except for years (4 digits)
-        query = re.sub(r"(?si)\b\d+\s*-+\s*\d+\b", " ", query)
-        query = re.sub(r"(?si)\b(\d{1,3}|\d{5,})\b", " ", query)
-        # remove preprint and other endings
-        query = re.sub(r"(?si)\b(preparation|arxiv|preprint|to\s+appear|" +
-                       r"submitted|translated\s+from).*",
-                       " ", query)
-        # remove publisher names, places and some other words
-        query = re.sub(r"Birkhauser|Springer|New York|Paris|Heidelberg|" +
-                       r"Boston|Basel|Grenoble|Verlag",
-                       "", query)
-        # short word with . is most likely an abbreviation
-        query = re.sub(r"(\b[a-zA-Z]{,4})\.", r"\1*", query)
-        # remove a few more characters
-        query = re.sub(r"[-.]", " ", query)
-        query = re.sub(r"\\", "", query)
-        query = re.sub(r"\s+\*+(\s+|$)", " ", query)
-        # remove extra white characters
-        query = re.sub(r"(?si)([\s\n\r]+)", " ", query).strip()
-        year = re.findall(r'\d{4}', query)
+        query = _BIBITEM.sub("", query)
+        for pattern, replacement in _CITATION_CLEANUP:
+            query = pattern.sub(replacement, query)
+        query = query.strip()
+        year = _YEAR.findall(query)
         if year and len(year) == 1:
             # extract year as separate field
-            query = re.sub(r'\d{4}', ' ', query)
+            query = _YEAR.sub(' ', query)
             return [('none', query), ('date', year[0])]
         else:
             return [('none', query)]
@@ -237,81 +660,93 @@ class Fetch(object):
         Detect fields and form a list.
 
         List format:
-        ['',                # empty
+        ['',                # empty Logic
         then repeated
-            ') and \n not (',    # parentheses and logic with new line
-            ('field', 'value'),
+            ') and \n not (',    # Logic: parentheses and connectors
+            ('field', 'value'),  # Field
 
         The same query can contain many values for the same field.
 
+        Parsed queries are cached, so all fetchers share the work.
+        """
+        parsed = _parsedFields.get(query)
+        if parsed is None:
+            parsed = tuple(self._parseFields(query))
+            _parsedFields.put(query, parsed)
+        return list(parsed)
+
+    def _parseFields(self, query):
+        """
+        Split query into fields and the logic between them.
+
+        Query is tokenized, and maximal runs of blanks, parentheses and
+        connectors containing a new line (or ending the query) separate
+        the fields. Connectors must be whole words, so e.g. Taylor does not
+        end with 'or'. Each field is then classified by its specifier.
         """
         # cleanup
-        # remove tex commands
-        query = re.sub(r"(?si)\\[A-Za-z]{2,}", "", query)
-        # remove accents, but not {?}
-        query = re.sub(r"(?si)\\\W|\\\w(?=\\|\{)", "", query).replace('~', ' ')
-        # remove formulas
-        query = re.sub(r"(?si)\$.*?\$", "", query)
-        # remove {}&?%=/#.
-        query = re.sub(r"[{}&?%=/#.]", "", query)
-
-        # TODO pyparse could make this easier
-        # try to find the fields by adding \n before each field indicator
-        query = re.sub(r"(?<=[\s()])([a-zA-Z]{2,3}|date|year|type):",
-                       r"\n\1:", query)
-        # start with new line to ensure parentheses/logic before the first query
-        query = '\n' + query
-        # split preserving and/or/not/(/) at the boundaries of the fields/lines
-        # this allows for rebuilding of a complex query with parentheses
-        lines = re.split(
-            r"(?si)((?:[\s()]|and|not|or)*" +  # before new line
-            r"(?:\n+|$)" +                     # new line or end
-            r"(?:[\s()]|and|not|or)*)",        # after new line
-            query)
+        for pattern, replacement in _FIELDS_CLEANUP:
+            query = pattern.sub(replacement, query)
+        # a new line before each field indicator, and before the first field
+        query = '\n' + _FIELD_START.sub(r"\n\1:", query)
+        tokens = _TOKEN.findall(query)
+        # alternating text and logic, as re.split with a capturing group
+        lines = []
+        text = []
+        i = 0
+        while i < len(tokens):
+            j = i
+            while j < len(tokens) and _isLogic(tokens[j]):
+                j += 1
+            logic = tokens[i:j]
+            if logic and (j == len(tokens) or '\n' in logic):
+                lines.append(''.join(text))
+                lines.append(''.join(logic))
+                text = []
+            else:
+                text.extend(logic)
+            if j < len(tokens):
+                text.append(tokens[j])
+            i = j + 1
+        lines.append(''.join(text))
         lst = []
         for line in lines:
-            if re.match(r"(?si)([\s()\n]|and|or|not)*$", line):
+            if all(_isLogic(t) for t in _TOKEN.findall(line)):
                 # parentheses and/or logic
-                lst.append(line)
+                lst.append(Logic(line))
                 continue
             # detect date (range) with or without field
-            date = re.match(
-                r"(?si)((?:py|yr|dt|date|year):[\D]*?)?" +     # field or not
-                r"([<=>]?\s*\d{4}(\s*-+\s*\d{4}|(\b\d{4}\b|[,\s])+)?)",  # dates
-                line)
-            author = re.match(r"(?si)(a|au|aut[hors]*):(?P<c>.*)", line)
-            journal = re.match(
-                r"(?si)(j|jo|jou[rnal]*|s|so|sou[rce]|jr*):(?P<c>.*)", line)
-            title = re.match(r"(?si)(t|ti|tit[le]*):(?P<c>.*)", line)
+            date = _DATE.match(line)
+            author = _AUTHOR.match(line)
+            journal = _JOURNAL.match(line)
+            title = _TITLE.match(line)
             if date:
-                lst.append(("date", date.group(2)))
-            elif re.match(r"type:|ty:|\s*(not\s)?\s*(book|journal|proceeding)",
-                          line):
+                lst.append(Field("date", date.group(2)))
+            elif _TYPE.match(line):
                 line = self._publicationType(line)
                 if line:
-                    lst.append(("type", line))
+                    lst.append(Field("type", line))
             elif author:
                 author = author.group("c").strip()
-                author = re.sub(r"(\w{2,},\s+\w)(?=\s|$)", r"\1*", author)
-                lst.append(("author", author))
+                author = _INITIAL.sub(r"\1*", author)
+                lst.append(Field("author", author))
             elif journal:
-                lst.append(("journal", journal.group("c").strip()))
+                lst.append(Field("journal", journal.group("c").strip()))
             elif title:
-                lst.append(("title", title.group("c").strip()))
-            elif re.match(r"(any|all|^):", line):
+                lst.append(Field("title", title.group("c").strip()))
+            elif _ALL.match(line):
                 # all fields search
-                lst.append(("all", re.sub(r".*?:\s*", "", line)))
-            elif re.match(r"\w{2,3}:", line):
+                lst.append(Field("all", re.sub(r".*?:\s*", "", line)))
+            elif _OTHER.match(line):
                 # unrecognized field
-                m = re.match(r"(?si)(\w{2,3}):\s*(.*)$", line)
-                lst.append(m.group(1, 2))
-            elif re.match(r"(?si)\s*\w+,\s+\w(\s|\*|$)", line):
+                lst.append(Field(*_OTHER.match(line).group(1, 2)))
+            elif _NAME.match(line):
                 # author without field specification
                 line = (line + '*').replace('**', '*')
-                lst.append(("author", '"'+line+'"'))
+                lst.append(Field("author", '"'+line+'"'))
             else:
                 # something
-                lst.append(("none", line))
+                lst.append(Field("none", line))
         return lst
 
     def _publicationType(self, line):
@@ -349,8 +784,8 @@ class Fetch(object):
         """
         Result processing should be implemented in subclasses.
 
-        Valid BibTex entries must be placed in self.refs.
-        Number of records should be placed in self.number.
+        Records must be placed in self.records, either directly or by
+        assigning BibTex entries to self.refs.
         """
         pass
 
@@ -358,23 +793,29 @@ class Fetch(object):
         """
         Return the list of fetched and formatted references.
 
-        Run BibTex if necessary.
+        Run BibTex if necessary. With formatLater option the references
+        are not formatted, see formatRefs.
         """
+        dct = self._formatOptions(format_dict)
+        if dct["bibtexOut"] or dct["formatLater"]:
+            return self.refs
+        return self._processBibTex(dct)
+
+    def _formatOptions(self, format_dict):
+        """ Options for BibTex, adjusted to the saved bibitem. """
         # nonexistent key get value "" (also evaluates to False)
         dct = defaultdict(str)
         try:
             dct.update(format_dict)
         except:
             pass
-        if dct["bibtexOut"]:
-            return self.refs
         if self.bibitem and dct["keepBibitems"]:
             # bibitem exists and should be kept, so do not generate
             dct["genBibitems"] = False
         if not dct["keepBibitems"] or dct["genBibitems"]:
             # remove saved bibitem if should be generated or not kept
             self.bibitem = ""
-        return self._processBibTex(dct)
+        return dct
 
     def _processBibTex(self, format_dict):
         """
@@ -382,9 +823,15 @@ class Fetch(object):
 
         Returns formatted string with citations.
         """
+        from bibtex import BibTex
+        refs = self.refs
+        key = formatKey(refs, format_dict)
+        formatted = _cachedFormat(key)
         try:
-            bib = BibTex(**format_dict)
-            formatted = bib.run(self.refs)
+            if formatted is None:
+                bib = BibTex(**format_dict)
+                formatted = bib.run(refs)
+                _saveFormat(key, formatted)
             assert formatted is not ""
 
             formatted = self.bibitem + formatted
@@ -392,34 +839,133 @@ class Fetch(object):
 
         except:
             # bibtex failed, return unformatted bibtex entries
-            return self.refs
-
-    def _cleanupBibTex(self, count):
-        """ Clean up bibtex and ensure uniform look. """
-        import bibtexparser
-        from bibtexparser.bparser import BibTexParser
-        parser = BibTexParser()
-        parser.customization = homogeneize_latex_encoding
-        bib = bibtexparser.loads(self.refs, parser=parser)
-
-        # save results
-        from bibtexparser.bwriter import BibTexWriter
-        writer = BibTexWriter()
-        writer.contents = ['entries']
-        writer.indent = '    '
-        writer.order_entries_by = ('id')
-        self.number = len(bib.entries)
-        self.refs = bibtexparser.dumps(bib, writer)
+            return refs
 
     def setBibtex(self, bibstr):
         """
         Use ready bibtex string in the fetcher.
 
         Can be used to get formatted references out of the fetcher.
+        The same string is parsed only once, e.g. when reformatting.
         """
-        bibstr = fixQuery(bibstr)
-        self.refs = str(bibstr)
-        self._cleanupBibTex(None)
+        bibstr = str(fixQuery(bibstr))
+        records = _parsedBibtex.get(bibstr)
+        if records is None:
+            self.refs = bibstr
+            _parsedBibtex.put(bibstr, tuple(self.records))
+        else:
+            self.records = list(records)
+        self.number = len(self.records)
+
+    def setRecords(self, records):
+        """ Use ready records in the fetcher. """
+        self.records = list(records)
+        self.number = len(self.records)
+
+
+def formatRefs(fetchers, format_dict):
+    """
+    Return getRefs outputs of all fetchers, e.g. of a batch run.
+
+    Fetchers are grouped by the options BibTex gets (they differ only if
+    some fetchers keep their bibitems), and each group is formatted by a
+    single BibTex object, see BibTex.runMany. Each fetcher is formatted
+    separately, so labels and order are the same as from getRefs.
+    """
+    from bibtex import BibTex, styleKey
+    format_dict = dict(format_dict, formatLater=False)
+    results = [None] * len(fetchers)
+    groups = OrderedDict()
+    for i, f in enumerate(fetchers):
+        dct = f._formatOptions(format_dict)
+        if dct["bibtexOut"]:
+            results[i] = f.refs
+            continue
+        groups.setdefault(styleKey(dct), (dct, []))[1].append(i)
+    for dct, indices in groups.values():
+        refs = [fetchers[i].refs for i in indices]
+        keys = [formatKey(bibstr, dct) for bibstr in refs]
+        formatted = [_cachedFormat(key) for key in keys]
+        missing = [j for j, text in enumerate(formatted) if text is None]
+        if missing:
+            try:
+                texts = BibTex(**dct).runMany([refs[j] for j in missing])
+            except:
+                texts = [""] * len(missing)
+            for j, text in zip(missing, texts):
+                formatted[j] = text
+                _saveFormat(keys[j], text)
+        for i, bibstr, text in zip(indices, refs, formatted):
+            # bibtex failed, return unformatted bibtex entries
+            results[i] = fetchers[i].bibitem + text if text else bibstr
+    return results
+
+
+def formatKey(bibstr, format_dict):
+    """
+    Cache key of BibTex output for bibstr with options from format_dict.
+
+    bibstr is written by bibfile.write, so the same records always give
+    the same string. Options that do not change the output are left out.
+    """
+    from bibtex import outputKey
+    if isinstance(bibstr, unicode):
+        bibstr = bibstr.encode('utf-8')
+    return hashlib.sha1(repr(outputKey(format_dict)) + '\n' +
+                        bibstr).hexdigest()
+
+
+def _cachedFormat(key):
+    """ Return formatted references saved by _saveFormat, or None. """
+    text = _formatted.get(key)
+    if text is None:
+        text = cache.formatted.get(key)
+        if text is not None:
+            _formatted.put(key, text)
+    return text
+
+
+def _saveFormat(key, text):
+    """ Remember formatted references, unless formatting failed. """
+    if text and isinstance(text, str):
+        _formatted.put(key, text)
+        cache.formatted.put(key, text, _FORMAT_TTL)
+
+
+class Query(namedtuple('Query', 'text fields bibitem ids')):
+
+    """
+    Query preprocessed once and shared by all fetchers.
+
+    text is the normalized query, fields is the tuple of generic fields
+    (None if no fetcher needs them) and bibitem the one found in a full
+    citation. ids is a tuple of
+    (fetcher class name, fields) for identifiers recognized by fetchers,
+    with empty fields if a fetcher did not find any.
+    """
+
+    __slots__ = ()
+
+    def idFields(self, fetcher):
+        """ Identifier fields for fetcher, or None if it was not asked. """
+        for name, fields in self.ids:
+            if name == fetcher.__class__.__name__:
+                return fields
+        return None
+
+
+def prepareQuery(query, fetchers=()):
+    """ Normalize and parse query, and detect identifiers for fetchers. """
+    if isinstance(query, Query):
+        return query
+    text = fixQuery(query)
+    generic = Fetch()
+    fields = None
+    if not fetchers or any(f.generic for f in fetchers):
+        fields = tuple(generic._parseQuery(text))
+    ids = tuple((f.__class__.__name__, tuple(f._idQuery(text) or ()))
+                for f in fetchers)
+    return Query(text, fields, generic.bibitem, ids)
 
 
 def fixQuery(query):
@@ -446,21 +992,29 @@ def fixQuery(query):
 
 
 # modified bibtexparser.latexenc content
+# importing bibtexparser takes longer than the rest of the startup, so its
+# table is loaded only when a non-ASCII character shows up
 
-from bibtexparser.latexenc import protect_uppercase, unicode_to_latex_map
+_NON_ASCII = re.compile(u'[^\x00-\x7f]')
+_UPPERCASE = re.compile('([^{]|^)([A-Z])([^}]|$)')
+_latexMap = None
 
 
 def string_to_latex(string):
     """ Convert a string to its latex equivalent. """
-    escape = [' ', '{', '}']
+    global _latexMap
+    if not _NON_ASCII.search(string):
+        return string
+    if _latexMap is None:
+        from bibtexparser.latexenc import unicode_to_latex_map
+        _latexMap = unicode_to_latex_map
+    return _NON_ASCII.sub(
+        lambda m: _latexMap.get(m.group(0), m.group(0)), string)
 
-    new = []
-    for char in string:
-        if char in escape or ord(char) < 128:
-            new.append(char)
-        else:
-            new.append(unicode_to_latex_map.get(char, char))
-    return ''.join(new)
+
+def protect_uppercase(string):
+    """ Put uppercase letters in braces. """
+    return _UPPERCASE.sub(r'\g<1>{\g<2>}\g<3>', string)
 
 
 def homogeneize_latex_encoding(record):
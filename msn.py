@@ -1,6 +1,6 @@
 """MathSciNet fetching classes."""
 
-from fetch import Fetch
+from fetch import Fetch, PageParser
 import re
 
 types = {'ref': 'REFF', 'ic': 'IC', 'se': 'SE', 'rt': 'RT', 'mr': 'MR',
@@ -10,6 +10,59 @@ types = {'ref': 'REFF', 'ic': 'IC', 'se': 'SE', 'rt': 'RT', 'mr': 'MR',
          'none': 'ALLF', 'type': 'ET', 'aid': 'INDI'}
 
 
+class PreParser(PageParser):
+
+    """ Collect text of <pre> elements, where BibTeX records are shown. """
+
+    def __init__(self, limit=None):
+        """ Not inside <pre> yet. """
+        PageParser.__init__(self, limit)
+        self.text = None
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'pre':
+            self.text = []
+
+    def handle_endtag(self, tag):
+        if tag == 'pre' and self.text is not None:
+            self.records.append(''.join(self.text))
+            self.text = None
+
+    def handle_data(self, data):
+        if self.text is not None:
+            self.text.append(data)
+
+
+class ResultsParser(PreParser):
+
+    """ Collect records from the document part and the number of matches. """
+
+    def __init__(self, limit=None):
+        """ Wait for the document part. """
+        PreParser.__init__(self, limit)
+        self.inDoc = False
+        self.total = None
+        self.tail = ""
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if tag == 'div' and (attrs.get('id') or '').startswith('foot'):
+            self.inDoc = False
+        elif 'doc' in attrs.values():
+            self.inDoc = True
+        elif self.inDoc:
+            PreParser.handle_starttag(self, tag, attrs)
+
+    def handle_data(self, data):
+        if self.text is None and self.total is None:
+            # number may be split between chunks, so keep a bit of text
+            self.tail = (self.tail + data)[-100:]
+            m = re.search(r'(?si)Matches:\D{0,40}?(\d+)\D', self.tail)
+            if m:
+                self.total = int(m.group(1))
+        PreParser.handle_data(self, data)
+
+
 class MathSciNet(Fetch):
 
     """ MathSciNet fetching class. """
@@ -21,16 +74,16 @@ class MathSciNet(Fetch):
     more = "r="
     correction = 1
     onceMax = 100
+    parser = ResultsParser
 
-    def _preprocessQuery(self, query):
-        """ Catch MR number query or execute regular preprocessing. """
+    def _idQuery(self, query):
+        """ Catch MR number query if present. """
         match = re.search(
             r"(?si)(mr:?|\\mref\s*\{|mrnumber\s*=\s*\{)\s*(mr)?\d{6,}",
             query)
         if match:
             return [("mr", ' or '.join(re.findall(r"\d{6,}", query)))]
-        else:
-            return super(MathSciNet, self)._preprocessQuery(query)
+        return None
 
     def _formatQuery(self, lst):
         """ Turn query into a string accepted by MathSciNet. """
@@ -69,10 +122,8 @@ class MathSciNet(Fetch):
         else:
             # fields with logical connector and parentheses
             # but no parentheses between MSN fields
-            logic = re.compile(r"(?si)(and|or|not)?[\s()\n]*$")
-            # connectors: find last and/or/not (and not will work too)
-            con = [logic.search(e).group(1) for e in lst[3::2]] + ['and']
-            con = [(e if e else 'and').upper() for e in con]
+            # connectors: last and/or/not (and not will work too)
+            con = [e.connector for e in lst[3::2]] + ['AND']
             # fields
             lst = [e for e in lst[2::2] if len(e) > 1]
             # add missing parentheses
@@ -100,7 +151,7 @@ class MathSciNet(Fetch):
         value = re.sub(r"(and|\s)+or(and|\s)+", " or ", value)
         value = re.sub(r"(and|\s)+not(and|\s)+", " not ", value)
         value = re.sub(r"(and|\s)+and(and|\s)+", " and ", value)
-        value = re.sub(r"^\s*(and|or)\s*|\s*(and|or|not)\s*$", "", value)
+        value = re.sub(r"^\s*(and|or)\b\s*|\s*\b(and|or|not)\s*$", "", value)
         sc = str(cell)
         return [("pg"+sc, key), ("co"+sc, logic), ("s"+sc, value)]
 
@@ -119,17 +170,15 @@ class MathSciNet(Fetch):
                 .replace('>', 'gt')
             return [("dr", "pubyear"), ("yrop", ineq), ("arg3", year)]
 
+    def _totalResults(self, data):
+        """ Read the number of matches from the results page. """
+        return self._parse(data).total
+
     def _processResults(self, data):
-        try:
-            data = re.match(r'(?si).*"doc">(.*)<div id="foot.*', data).group(1)
-            data = ''.join(data.split('<pre>')[1:])
-            data = re.sub(r'</?(div|pre)>', '', data)
-            data = re.sub(r"(?mi)MRNUMBER\s*=\s*\{(.*?)(\s|\}).*",
-                          r"MRNUMBER = {\1},", data)
-            data = data.replace(r'&lt;', '<').replace(r'&gt;', '>') \
-                .replace(r'&amp;', '&')
-        except:
-            data = ""
+        """ Join bibtex records collected by ResultsParser. """
+        data = '\n'.join(self._parse(data).records)
+        data = re.sub(r"(?mi)MRNUMBER\s*=\s*\{(.*?)(\s|\}).*",
+                      r"MRNUMBER = {\1},", data)
         self.refs = data
 
     def _cleanWebsite(self, data):
@@ -160,10 +209,12 @@ class MRef(Fetch):
     """
 
     url = "http://www.ams.org/mathscinet-mref?dataType=bibtex&"
+    parser = PreParser
+    generic = False
 
     def _preprocessQuery(self, query):
         """ Return almost full query without any preprocessing. """
-        query = re.sub(r'(?si)\bEdited\s+by\b', ' ', query)
+        query = re.sub(r'(?si)\bEdited\s+by\b', ' ', query.text)
         return [('ref', query)]
 
     def _formatQuery(self, query):
@@ -172,13 +223,8 @@ class MRef(Fetch):
 
     def _processResults(self, data):
         """ Try to get the only bibtex record present in the html document. """
-        m = re.match(r'.*(?si)<pre>(.*?)</pre>', data)
-        if m and m.group(1):
-            data = m.group(1)
-        else:
-            data = ""
+        records = self._parse(data).records
+        data = records[-1] if records else ""
         data = re.sub(r"(?mi)MRNUMBER\s*=\s*\{(.*?)(\s|\}).*",
                       r"MRNUMBER = {\1},", data)
-        data = data.replace(r'&lt;', '<').replace(r'&gt;', '>') \
-            .replace(r'&amp;', '&')
         self.refs = data
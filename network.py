@@ -0,0 +1,490 @@
+""" Shared HTTP connection handling for all fetchers. """
+
+import base64
+import httplib
+import random
+import socket
+import sys
+import threading
+import time
+import urllib
+import urlparse
+import zlib
+import cache
+
+
+_POOL_SIZE = 4       # idle connections kept per host
+_HOST_LIMIT = 4      # requests in flight per host
+_IDLE_TIMEOUT = 30   # seconds after which an idle connection is dropped
+_MAX_REDIRECTS = 5
+_TIMEOUT = 60        # seconds for connect and each read if none given
+_WORKERS = 4         # concurrent requests in parallelMap
+_RETRIES = 3         # attempts after a transient failure
+_BACKOFF = 0.5       # seconds before the first retry, doubled every time
+_MAX_WAIT = 60       # longest Retry-After we are willing to honor
+_TRANSIENT = {429, 500, 502, 503, 504}
+# sustained requests per second and burst size for known hosts
+_RATES = {'ams.org': (5, 10),
+          'zbmath.org': (5, 10),
+          'front.math.ucdavis.edu': (2, 4)}
+_CHUNK = 16384       # bytes read from a socket at once
+_HEADERS = {'User-Agent': 'Python-urllib/' + sys.version[:3],
+            'Connection': 'keep-alive',
+            'Accept-Encoding': 'gzip, deflate'}
+
+
+class HTTPError(IOError):
+
+    """ Server responded with an error status. """
+
+    def __init__(self, url, code, reason=""):
+        IOError.__init__(self, "HTTP Error {0}: {1}".format(code, reason))
+        self.url = url
+        self.code = code
+
+
+class OutOfTime(socket.timeout):
+
+    """ Deadline passed before the request could be sent. """
+
+
+# errors meaning the server could not be reached or did not answer
+errors = (IOError, httplib.HTTPException)
+
+# bytes received from servers and after decompression
+stats = {'wire': 0, 'decoded': 0}
+_statsLock = threading.Lock()
+
+
+def _count(wire, decoded):
+    """ Update transfer statistics. """
+    with _statsLock:
+        stats['wire'] += wire
+        stats['decoded'] += decoded
+
+
+def statsText(before=None):
+    """ Describe bytes received since stats were copied to before. """
+    with _statsLock:
+        wire, decoded = stats['wire'], stats['decoded']
+    if before:
+        wire -= before['wire']
+        decoded -= before['decoded']
+    return "received {0:.1f} kB, {1:.1f} kB after decompression".format(
+        wire / 1024.0, decoded / 1024.0)
+
+
+def decodedChunks(response):
+    """
+    Read response in chunks and yield them decompressed.
+
+    Handles gzip and deflate (with or without zlib header) encodings.
+    """
+    encoding = (response.getheader('content-encoding') or '').lower()
+    decoder = None
+    if encoding in ('gzip', 'x-gzip'):
+        decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    elif encoding == 'deflate':
+        decoder = zlib.decompressobj()
+    wire = decoded = 0
+    first = True
+    try:
+        while True:
+            chunk = response.read(_CHUNK)
+            if not chunk:
+                break
+            wire += len(chunk)
+            if decoder is not None:
+                try:
+                    chunk = decoder.decompress(chunk)
+                except zlib.error:
+                    if not first or encoding != 'deflate':
+                        raise
+                    # some servers send raw deflate data without zlib header
+                    decoder = zlib.decompressobj(-zlib.MAX_WBITS)
+                    chunk = decoder.decompress(chunk)
+            first = False
+            decoded += len(chunk)
+            yield chunk
+        if decoder is not None:
+            chunk = decoder.flush()
+            decoded += len(chunk)
+            yield chunk
+    finally:
+        # also counts responses abandoned by the reader
+        _count(wire, decoded)
+
+
+class TokenBucket(object):
+
+    """
+    Rate limiter allowing self.rate requests per second on average.
+
+    Up to self.burst requests can be sent at once after a quiet period.
+    Waiting threads are served in the order in which they arrived.
+    """
+
+    def __init__(self, rate, burst):
+        """ Start with a full bucket. """
+        self.rate = float(rate)
+        self.burst = burst
+        self.tokens = float(burst)
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        """ Add tokens for the time since last call. Lock must be held. """
+        now = time.time()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def acquire(self, deadline=None):
+        """
+        Take a token, waiting for it if necessary.
+
+        Raises OutOfTime without taking a token if it would not be
+        available before deadline.
+        """
+        with self.lock:
+            self._refill()
+            # negative tokens are reservations of future tokens
+            wait = (1 - self.tokens) / self.rate
+            if deadline is not None and time.time() + wait > deadline:
+                raise OutOfTime("timed out")
+            self.tokens -= 1
+        if wait > 0:
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        """ Do not allow any requests for the next few seconds. """
+        with self.lock:
+            self._refill()
+            self.tokens = min(self.tokens, 0) - seconds * self.rate
+
+
+def retryAfter(value):
+    """ Seconds to wait according to Retry-After header, or None. """
+    if not value:
+        return None
+    try:
+        seconds = float(value)
+    except ValueError:
+        from email.utils import mktime_tz, parsedate_tz
+        date = parsedate_tz(value)
+        if date is None:
+            return None
+        seconds = mktime_tz(date) - time.time()
+    return min(max(seconds, 0), _MAX_WAIT)
+
+
+class ConnectionPool(object):
+
+    """
+    Thread-safe pool of keep-alive connections grouped by host.
+
+    A connection is checked out for the duration of a single request, so
+    concurrent workers never share a socket. At most self.size idle
+    connections are kept per host, and connections idle for longer than
+    self.idle seconds are closed instead of reused.
+
+    At most self.limit requests are sent to the same host at once, so any
+    number of worker threads can share the pool without flooding a server.
+    Requests to hosts listed in _RATES are also spaced by a token bucket,
+    and transient failures are retried with jittered exponential backoff.
+
+    Proxies are taken from the environment (http_proxy, https_proxy,
+    no_proxy) or system settings, like urllib does. HTTPS requests are
+    tunneled through the proxy.
+    """
+
+    def __init__(self, size=_POOL_SIZE, idle=_IDLE_TIMEOUT, limit=_HOST_LIMIT):
+        """ Create an empty pool. """
+        self.size = size
+        self.idle = idle
+        self.limit = limit
+        self.lock = threading.Lock()
+        # (scheme, host) -> list of (connection, time of last use)
+        self.connections = {}
+        # host -> semaphore limiting requests in flight
+        self.slots = {}
+        # host -> TokenBucket, or None if the rate is not limited
+        self.buckets = {}
+        # scheme -> proxy url, read on the first request
+        self.proxies = None
+
+    def _slot(self, host):
+        """ Return semaphore guarding requests to host. """
+        with self.lock:
+            if host not in self.slots:
+                self.slots[host] = threading.BoundedSemaphore(self.limit)
+            return self.slots[host]
+
+    def _proxy(self, scheme, host):
+        """ Return (address, authorization) of proxy for host, or None. """
+        with self.lock:
+            if self.proxies is None:
+                self.proxies = urllib.getproxies()
+            proxy = self.proxies.get(scheme)
+        if not proxy or urllib.proxy_bypass(host.split(':')[0]):
+            return None
+        if '://' not in proxy:
+            proxy = 'http://' + proxy
+        parts = urlparse.urlsplit(proxy)
+        auth = None
+        if parts.username:
+            auth = 'Basic ' + base64.b64encode('{0}:{1}'.format(
+                urllib.unquote(parts.username),
+                urllib.unquote(parts.password or '')))
+        return parts.netloc.rsplit('@', 1)[-1], auth
+
+    def _acquire(self, scheme, host, timeout, proxy=None):
+        """ Return an idle connection to host or open a new one. """
+        now = time.time()
+        stale = []
+        conn = None
+        with self.lock:
+            # idle list is ordered by time of last use
+            idle = self.connections.get((scheme, host), [])
+            while idle and now - idle[0][1] >= self.idle:
+                stale.append(idle.pop(0)[0])
+            if idle:
+                conn = idle.pop()[0]
+        for c in stale:
+            c.close()
+        if conn is not None:
+            conn.timeout = timeout
+            if conn.sock is not None:
+                conn.sock.settimeout(timeout)
+            return conn, True
+        if proxy is not None:
+            address, auth = proxy
+            if scheme == 'https':
+                conn = httplib.HTTPSConnection(address, timeout=timeout)
+                conn.set_tunnel(host, headers=auth and
+                                {'Proxy-Authorization': auth})
+                return conn, False
+            return httplib.HTTPConnection(address, timeout=timeout), False
+        if scheme == 'https':
+            return httplib.HTTPSConnection(host, timeout=timeout), False
+        return httplib.HTTPConnection(host, timeout=timeout), False
+
+    def _bucket(self, host):
+        """ Return rate limiter for host or None. """
+        with self.lock:
+            if host not in self.buckets:
+                self.buckets[host] = None
+                name = host.split(':')[0]
+                for domain, rate in _RATES.items():
+                    if name == domain or name.endswith('.' + domain):
+                        self.buckets[host] = TokenBucket(*rate)
+            return self.buckets[host]
+
+    def _release(self, scheme, host, conn):
+        """ Put connection back in the pool, or close it if pool is full. """
+        with self.lock:
+            idle = self.connections.setdefault((scheme, host), [])
+            if len(idle) < self.size:
+                idle.append((conn, time.time()))
+                return
+        conn.close()
+
+    def request(self, url, headers=None, timeout=None, parser=None):
+        """
+        Execute GET request and return the body of the response.
+
+        timeout (in seconds) applies to connecting and to every read.
+        If given, it also limits the total time spent on retries.
+
+        If parser class is given, a new parser is fed the body chunk by
+        chunk as it arrives, and (body, parser) is returned. If the parser
+        becomes full (see fetch.PageParser), the rest of the response is
+        not downloaded and body is None.
+        """
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        for _ in range(_MAX_REDIRECTS + 1):
+            response, body, sink = self._retry(url, headers, deadline, parser)
+            location = response.getheader('location')
+            if response.status in (301, 302, 303, 307, 308) and location:
+                url = urlparse.urljoin(url, location)
+                continue
+            if response.status >= 400:
+                raise HTTPError(url, response.status, response.reason)
+            if parser is not None:
+                return body, sink
+            return body
+        raise HTTPError(url, response.status, "too many redirects")
+
+    def _retry(self, url, headers, deadline, parser):
+        """ Execute request, retry after transient failures. """
+        host = urlparse.urlsplit(url).netloc.lower()
+        bucket = self._bucket(host)
+        for attempt in range(_RETRIES + 1):
+            wait = _BACKOFF * 2**attempt * random.uniform(0.5, 1.5)
+            try:
+                if bucket:
+                    bucket.acquire(deadline)
+                timeout = _TIMEOUT
+                if deadline is not None:
+                    timeout = deadline - time.time()
+                    if timeout <= 0:
+                        raise OutOfTime("timed out")
+            except OutOfTime:
+                if attempt:
+                    # report why the earlier attempt failed
+                    raise error
+                raise
+            try:
+                response, body, sink = self._get(url, headers, timeout,
+                                                 parser)
+            except socket.timeout:
+                # waiting again is unlikely to help
+                raise
+            except (httplib.HTTPException, socket.error) as e:
+                error = e
+            else:
+                if response.status not in _TRANSIENT:
+                    return response, body, sink
+                error = HTTPError(url, response.status, response.reason)
+                after = retryAfter(response.getheader('retry-after'))
+                if after is not None:
+                    wait = after
+                    if bucket:
+                        # server wants everybody to slow down
+                        bucket.pause(after)
+            if attempt == _RETRIES or \
+                    (deadline is not None and time.time() + wait > deadline):
+                raise error
+            time.sleep(wait)
+
+    def _get(self, url, headers, timeout, parser):
+        """ Single GET request without redirect handling. """
+        parts = urlparse.urlsplit(url)
+        scheme, host = parts.scheme.lower(), parts.netloc
+        path = urlparse.urlunsplit(('', '', parts.path or '/', parts.query, ''))
+        hdrs = dict(_HEADERS)
+        if headers:
+            hdrs.update(headers)
+        proxy = self._proxy(scheme, host)
+        if proxy is not None and scheme == 'http':
+            # plain requests through a proxy name the whole url
+            path = urlparse.urlunsplit((scheme, host, parts.path or '/',
+                                        parts.query, ''))
+            if proxy[1]:
+                hdrs['Proxy-Authorization'] = proxy[1]
+        with self._slot(host):
+            while True:
+                conn, reused = self._acquire(scheme, host, timeout, proxy)
+                sink = parser() if parser is not None else None
+                try:
+                    conn.request('GET', path, headers=hdrs)
+                    response = conn.getresponse()
+                    body = []
+                    complete = True
+                    for chunk in decodedChunks(response):
+                        body.append(chunk)
+                        if sink is not None:
+                            # parse while the rest is still on the way
+                            sink.feed(chunk)
+                            if getattr(sink, 'full', False):
+                                complete = False
+                                break
+                    body = ''.join(body) if complete else None
+                except zlib.error as e:
+                    conn.close()
+                    raise httplib.HTTPException("corrupt response: " + str(e))
+                except (httplib.HTTPException, socket.error) as e:
+                    conn.close()
+                    if reused and not isinstance(e, socket.timeout):
+                        # server closed a kept-alive connection, try again
+                        # (a timeout would only start over with a new one)
+                        continue
+                    raise
+                except:
+                    # parser failed, response was not read completely
+                    conn.close()
+                    raise
+                break
+        if response.will_close or not complete:
+            # unread rest of the response would confuse the next request
+            conn.close()
+        else:
+            self._release(scheme, host, conn)
+        return response, body, sink
+
+    def clear(self):
+        """ Close all idle connections. """
+        with self.lock:
+            connections = self.connections
+            self.connections = {}
+        for idle in connections.values():
+            for c, _ in idle:
+                c.close()
+
+
+# pool shared by all fetchers
+pool = ConnectionPool()
+
+
+def request(url, headers=None, ttl=0, timeout=None):
+    """
+    Fetch url using the shared connection pool.
+
+    If ttl is given, the response is looked up in and saved to the
+    persistent cache for ttl seconds.
+    """
+    if ttl:
+        key = cache.normalizeUrl(url)
+        body = cache.responses.get(key)
+        if body is not None:
+            return body
+    body = pool.request(url, headers, timeout)
+    if ttl:
+        cache.responses.put(key, body, ttl)
+    return body
+
+
+def parse(url, parser, headers=None, ttl=0, timeout=None):
+    """
+    Fetch url like request, and return parser fed with the response.
+
+    parser is a class with feed and close methods, e.g. HTMLParser.
+    Downloaded chunks are parsed as soon as they arrive.
+    """
+    body = None
+    if ttl:
+        key = cache.normalizeUrl(url)
+        body = cache.responses.get(key)
+    if body is not None:
+        sink = parser()
+        sink.feed(body)
+    else:
+        body, sink = pool.request(url, headers, timeout, parser)
+        if ttl and body is not None:
+            cache.responses.put(key, body, ttl)
+    sink.close()
+    return sink
+
+
+def forget(url):
+    """ Remove response for url from the persistent cache. """
+    cache.responses.delete(cache.normalizeUrl(url))
+
+
+def parallelMap(fun, items, workers=_WORKERS):
+    """
+    Apply fun to all items using at most workers threads.
+
+    Results are returned in the order of items.
+    """
+    items = list(items)
+    if len(items) < 2:
+        return [fun(i) for i in items]
+    from multiprocessing.pool import ThreadPool
+    threads = ThreadPool(min(workers, len(items)))
+    try:
+        return threads.map(fun, items)
+    finally:
+        threads.close()
@@ -20,11 +20,15 @@ def worker(input, output):
         while True:
             i, fun, args = input.get(False)
             result = fun(*args)
-            # return (fetcher name, result, nonunique, number of results, index)
+            # return fetcher name, result, nonunique, number of results,
+            # whether it ran out of time or failed, index and query
             output.put({'name': fun.__class__.__name__,
                         'result': result,
                         'nonunique': fun.nonunique,
                         'number': fun.number,
+                        'partial': getattr(fun, 'partial', False),
+                        'failed': getattr(fun, 'failed', False),
+                        'skipped': getattr(fun, 'skipped', False),
                         'index': i,
                         'query': args[0]})
     except Queue.Empty:
@@ -36,12 +40,12 @@ class Progress(QProgressDialog):
     """Progress dialog with an option to cancel execution of the computation."""
 
     def __init__(self, fun, args=[], job="Working...",
-                 failure=lambda x: x['number'] == 0):
+                 failure=lambda x: x['number'] == 0, threads=4):
         """
         Create worker threads.
 
         Function 'failure' can be used to decide what constitutes failure of
-        the fetching process.
+        the fetching process. At most 'threads' tasks run at the same time.
         """
         self.failure = failure
         try:
@@ -59,7 +63,7 @@ class Progress(QProgressDialog):
         self.setModal(True)
         for i, fa in enumerate(zip(fun, args)):
             self.input.put((i, fa[0], fa[1]))
-        for _ in range(min(4, self.length)):
+        for _ in range(min(threads, self.length)):
             t = threading.Thread(target=worker, args=(self.input, self.output))
             t.daemon = True
             t.start()
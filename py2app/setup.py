@@ -41,6 +41,8 @@ OPTIONS = {'argv_emulation': False,
                          'cite.py', 'citeWindow.py', 'citeTerminal.py',
                          'batch.py', 'progress2.py', 'bibtex.py', 'config.py',
                          'default.bst', 'fetch.py', 'settings.xml',
+                         'network.py', 'cache.py', 'bibfile.py',
+                         'citeDaemon.py', 'bst.py',
                          'py2app/cite', 'doc'],
            }
 
@@ -1,13 +1,31 @@
 """ Zentralblatt fetching classes. """
 
-from fetch import Fetch
+from fetch import Fetch, PageParser, DeadlineExceeded
+import bibfile
 import re
-import urllib
 
 types = {'title': 'ti', 'author': 'au', 'pu': 'pu', 'msc': 'cc',
          'journal': 'so', 'la': 'la', 'none': 'any', 'type': 'dt',
          'id': 'an', 'zbl': 'an'}
 
+# last name in braces, matching braces up to 3 levels deep
+_LAST_NAME = re.compile("(?si)(.*?)\\{(" + r"[^{}]*?(?:\{"*3 +
+                        r"[^{}]*?"+r"\}[^{}]*?)*?"*3 + r")\}$")
+_INITIALS = re.compile(r'\.(\w\.)')
+
+
+class ResultsParser(PageParser):
+
+    """ Collect links to BibTeX records in the order they appear. """
+
+    link = re.compile(r"(?si)bibtex/.*?\d{3,}\.bib")
+
+    def handle_starttag(self, tag, attrs):
+        for _, value in attrs:
+            m = self.link.search(value or '')
+            if m:
+                self.records.append(m.group(0))
+
 
 class Zbl(Fetch):
 
@@ -15,9 +33,10 @@ class Zbl(Fetch):
 
     url = "http://zbmath.org/?"
     more = ""
+    parser = ResultsParser
 
-    def _preprocessQuery(self, query):
-        """ Catch Zbl number query or execute regular preprocessing. """
+    def _idQuery(self, query):
+        """ Catch Zbl number query if present. """
         match = re.search(
             r"(?si)(zbl:|zbmath:?|\\zbl\s*\{|zbl\s*=\s*\{)\s*(zbl|zbmath)?"
             r"\d{4}\.?\d{4,}",
@@ -25,8 +44,7 @@ class Zbl(Fetch):
         if match:
             return [("zbl",
                      ' or '.join(re.findall(r"\b\d{4}\.?\d{4,}\b", query)))]
-        else:
-            return super(Zbl, self)._preprocessQuery(query)
+        return None
 
     def _formatQuery(self, lst):
         """
@@ -81,30 +99,45 @@ class Zbl(Fetch):
 
     def _processResults(self, data):
         """ Get bibtex data from zbMATH website. """
-        bibs = re.findall("(?si)bibtex/.*?\d{3,}\.bib", data)
-        data = []
-        import bibtexparser
-        from bibtexparser.bparser import BibTexParser
-        parser = BibTexParser()
-        parser.customization = customizations
+        import network
+        # each record is a separate download, so get only as many as needed
+        # (one more than count shows that the result is not unique)
+        bibs = self._parse(data).records[:self.count + 1]
+        # records are downloaded concurrently, but kept in page order
+        records = network.parallelMap(self._processRecord, bibs)
+        self.refs = "\n".join(r for r in records if r)
+
+    def _processRecord(self, bib):
+        """
+        Download a single record and find its MRef match if requested.
+
+        Returns empty string if the record could not be downloaded, so that
+        the records which did arrive are kept.
+        """
+        import network
+        try:
+            # records do not change, unlike search results
+            bibtext = self._request("https://zbmath.org/" + bib,
+                                    ttl=self.cacheTTL)
+        except (DeadlineExceeded,) + network.errors as e:
+            self._missed(e)
+            return ""
+        zbl = bibfile.loads(bibtext, customizations)
         if self.otherID:
-            # setup for MRef fetching
             from msn import MRef
             mr = MRef()
-        for bib in bibs:
-            bibtext = urllib.urlopen("https://zbmath.org/" + bib).read()
-            zbl = bibtexparser.loads(bibtext, parser=parser)
-            if self.otherID and mr.fetch(bibtext):
+            mr.cancel = self.cancel
+            mr.deadline = self.deadline
+            if mr.fetch(bibtext):
                 # found MRef match for zbMATH record
-                msn = bibtexparser.loads(mr.refs)
+                msn = bibfile.loads(mr.refs)
                 # use MSN bibtex entry with zbl number added
                 # and doi transfered if missing
-                msn.entries[0]['zbl'] = zbl.entries[0]['zbl']
-                if 'doi' not in msn.entries[0] and 'doi' in zbl.entries[0]:
-                    msn.entries[0]['doi'] = zbl.entries[0]['doi']
+                msn[0]['zbl'] = zbl[0]['zbl']
+                if 'doi' not in msn[0] and 'doi' in zbl[0]:
+                    msn[0]['doi'] = zbl[0]['doi']
                 zbl = msn
-            data.append(bibtexparser.dumps(zbl))
-        self.refs = "\n".join(data)
+        return bibfile.dumps(zbl)
 
 
 def customizations(record):
@@ -121,14 +154,12 @@ def customizations(record):
         record[ID] = 'Zbl' + record["zbl"]
     try:
         # put authors in last, first form
-        n = 3  # match braces n levels deep
         authors = str(record["author"]).split(' and ')
         fixed = []
         for author in authors:
-            m = re.match("(?si)(.*?)\{(" + r"[^{}]*?(?:\{"*n +
-                         r"[^{}]*?"+r"\}[^{}]*?)*?"*n + r")\}$", author)
+            m = _LAST_NAME.match(author)
             fixed.append(m.group(2).strip() + ', ' +
-                         re.sub(r'\.(\w\.)', r'. \1', m.group(1).strip()))
+                         _INITIALS.sub(r'. \1', m.group(1).strip()))
         record["author"] = " and ".join(fixed)
     except:
         pass